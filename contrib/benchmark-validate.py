@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#
+# Compare the time the component schema checks take with voluptuous
+# and with the compiled checks of dep11.validate, on a Components file.
+#
+# Usage: benchmark-validate.py Components-amd64.yml.gz
+
+import os
+import sys
+import time
+import gzip
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dep11.validate import DEP11Validator, schema_component, _check_component
+
+
+def time_checks(docs, check):
+    start = time.perf_counter()
+    valid = 0
+    for doc in docs:
+        if check(doc):
+            valid += 1
+    return (time.perf_counter() - start, valid)
+
+
+def check_voluptuous(doc):
+    try:
+        schema_component(doc)
+    except Exception:
+        return False
+    return True
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: %s COMPONENTS-FILE" % (sys.argv[0]))
+        sys.exit(1)
+    fname = sys.argv[1]
+
+    with gzip.open(fname, 'rt', encoding='utf-8') as f:
+        docs = [doc for doc in yaml.safe_load_all(f) if doc and doc.get('ID')]
+    print("Loaded %i components." % (len(docs)))
+
+    vol_time, vol_valid = time_checks(docs, check_voluptuous)
+    fast_time, fast_valid = time_checks(docs, _check_component)
+    print("voluptuous: %.3fs (%i valid)" % (vol_time, vol_valid))
+    print("compiled:   %.3fs (%i valid)" % (fast_time, fast_valid))
+    if fast_time > 0:
+        print("speedup:    %.1fx" % (vol_time / fast_time))
+
+    start = time.perf_counter()
+    validator = DEP11Validator()
+    validator.validate_file(fname)
+    print("full validation: %.3fs (%i issues)" % (time.perf_counter() - start, len(validator.issue_list)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+/*
+ * Filter the packages of an index by name, maintainer or details,
+ * using the search index next to the page.
+ */
+function setupPackageFilter(indexUrl) {
+    var input = document.getElementById("package-filter");
+    var results = document.getElementById("package-filter-results");
+    var entries = null;
+
+    function update() {
+        results.innerHTML = "";
+        var query = input.value.trim().toLowerCase();
+        if (!entries || query.length < 2)
+            return;
+
+        var count = 0;
+        for (var i = 0; i < entries.length && count < 200; i++) {
+            /* entries are [package, maintainer, details] */
+            var entry = entries[i];
+            if (entry.join("\n").toLowerCase().indexOf(query) < 0)
+                continue;
+
+            var li = document.createElement("li");
+            var link = document.createElement("a");
+            link.href = entry[0] + ".html";
+            link.textContent = entry[0];
+            li.appendChild(link);
+            var details = " - " + entry[1];
+            if (entry[2])
+                details += " (" + entry[2] + ")";
+            li.appendChild(document.createTextNode(details));
+            results.appendChild(li);
+            count++;
+        }
+    }
+
+    var req = new XMLHttpRequest();
+    req.onload = function() {
+        entries = JSON.parse(req.responseText);
+        update();
+    };
+    req.open("GET", indexUrl);
+    req.send();
+
+    input.addEventListener("input", update);
+}
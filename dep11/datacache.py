@@ -16,18 +16,44 @@
 # License along with this program.
 
 import os
-import glob
+import fcntl
 import shutil
 import logging as log
+import zlib
+import gzip
+import yaml
 import lmdb
 from math import pow
 
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+# compressed values start with a zero byte, which can never be
+# the first byte of the YAML data we store, followed by the codec
+_VALUE_ZLIB = b'\x00z'
+_VALUE_ZSTD = b'\x00Z'
+
+# values smaller than this are not worth compressing
+_COMPRESS_MIN_SIZE = 128
+
+# number of cached values needed to train a compression dictionary,
+# and the maximum number of values we use for training
+_ZSTD_DICT_MIN_SAMPLES = 256
+_ZSTD_DICT_MAX_SAMPLES = 20000
+_ZSTD_DICT_SIZE = 112640
+
 
 def tobytes(s):
     if isinstance(s, bytes):
         return s
     return bytes(s, 'utf-8')
 
+def _make_fragment(data):
+    # a standalone gzip member without timestamp, so the export stays reproducible
+    return gzip.compress(tobytes(data), 9, mtime=0)
+
 class DataCache:
     """ A LMDB based cache for the DEP-11 generator """
 
@@ -35,7 +61,16 @@ class DataCache:
         self._pkgdb = None
         self._hintsdb = None
         self._datadb = None
+        self._metadb = None
+        self._gidpkgdb = None
+        self._orphansdb = None
+        self._cptinfodb = None
+        self._snapshotsdb = None
+        self._fragmentsdb = None
+        self._iconsdb = None
+        self._highlightdb = None
         self._dbenv = None
+        self._lock_file = None
         self.cache_dir = None
         self._opened = False
 
@@ -44,17 +79,312 @@ class DataCache:
         # set a huge map size to be futureproof.
         # This means we're cruel to non-64bit users, but this
         # software is supposed to be run on 64bit machines anyway.
-        self._map_size = pow(1024, 4)
+        self._map_size = int(pow(1024, 4))
+        # grow the map by this amount if it is full, see open()
+        self._map_growth = 0
+
+        # durability settings, see open()
+        self._sync = True
+        self._metasync = True
+        self._writemap = False
+        self._readahead = True
+        self._unclean = False
+        self._readonly = False
+
+        # value compression, see open()
+        self._compression = None
+        self._zcompressor = None
+        self._zdecompressors = dict()
 
-    def open(self, cachedir):
-        self._dbenv = lmdb.open(cachedir, max_dbs=3, map_size=self._map_size)
+    def _open_env(self):
+        # every process using the cache holds a shared lock on this file,
+        # so compact() can tell whether the database is in use
+        lock_fname = os.path.join(self.cache_dir, "dep11.lock")
+        if not self._readonly:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        if not self._readonly or os.path.exists(lock_fname):
+            self._lock_file = open(lock_fname, 'r' if self._readonly else 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_SH)
 
-        self._pkgdb = self._dbenv.open_db(b'packages')
-        self._hintsdb = self._dbenv.open_db(b'hints')
-        self._datadb = self._dbenv.open_db(b'metadata')
+        self._dbenv = lmdb.open(self.cache_dir, max_dbs=11, map_size=self._map_size,
+                                sync=self._sync, metasync=self._metasync,
+                                writemap=self._writemap, readahead=self._readahead,
+                                readonly=self._readonly)
+
+        self._pkgdb = self._open_db(b'packages')
+        self._hintsdb = self._open_db(b'hints')
+        self._datadb = self._open_db(b'metadata')
+        self._metadb = self._open_db(b'meta')
+        # global-id -> package-ids referencing the component
+        self._gidpkgdb = self._open_db(b'gid_packages')
+        # global-ids which are no longer referenced by any package
+        self._orphansdb = self._open_db(b'orphans')
+        # global-id -> package name, component-id, type and icon, to avoid parsing the metadata
+        self._cptinfodb = self._open_db(b'cpt_info')
+        # suite/component/arch -> package-ids processed in the last run
+        self._snapshotsdb = self._open_db(b'index_snapshots')
+        # gzip members of the data and hints of each package, ready for export
+        self._fragmentsdb = self._open_db(b'fragments')
+        # global-id -> icons stored in the media directory, as "size/filename" lines
+        self._iconsdb = self._open_db(b'icons')
+        # global-id -> syntax-highlighted metadata for the HTML pages
+        self._highlightdb = self._open_db(b'highlight')
 
         self._opened = True
+
+    def _open_db(self, name):
+        if not self._readonly:
+            return self._dbenv.open_db(name)
+        # read-only caches can't create databases, which were added by later versions
+        try:
+            return self._dbenv.open_db(name, create=False)
+        except lmdb.NotFoundError:
+            return None
+
+    def _begin(self, db=None, write=False):
+        try:
+            return self._dbenv.begin(db=db, write=write)
+        except lmdb.MapResizedError:
+            # another process has grown the map, adopt its new size
+            self._dbenv.set_mapsize(0)
+            self._map_size = self._dbenv.info()['map_size']
+            return self._dbenv.begin(db=db, write=write)
+
+    def _write(self, func, db=None):
+        '''
+        Run func with a new write transaction, growing the
+        map and retrying if it is full.
+        '''
+        if self._readonly:
+            raise Exception("Can not write to a cache which was opened read-only.")
+
+        # without synchronous commits, a crash can leave the database in an
+        # inconsistent state. Mark the cache as unclean until the next explicit sync.
+        if not self._sync and not self._unclean:
+            marker = self._get_unclean_marker()
+            if not os.path.exists(marker):
+                open(marker, 'w').close()
+            self._unclean = True
+
+        while True:
+            try:
+                with self._begin(db=db, write=True) as txn:
+                    return func(txn)
+            except lmdb.MapFullError:
+                if not self._map_growth:
+                    raise
+                self._map_size = self._dbenv.info()['map_size'] + self._map_growth
+                log.info("Cache is full, growing its map to %i bytes." % (self._map_size))
+                self._dbenv.set_mapsize(self._map_size)
+
+    def _get_databases(self):
+        return {'packages': self._pkgdb,
+                'hints': self._hintsdb,
+                'metadata': self._datadb,
+                'meta': self._metadb,
+                'gid_packages': self._gidpkgdb,
+                'orphans': self._orphansdb,
+                'cpt_info': self._cptinfodb,
+                'index_snapshots': self._snapshotsdb,
+                'fragments': self._fragmentsdb,
+                'icons': self._iconsdb,
+                'highlight': self._highlightdb}
+
+    def _get_unclean_marker(self):
+        return os.path.join(self.cache_dir, "unclean")
+
+    def open(self, cachedir, sync=True, metasync=True, writemap=False, readahead=True, check_integrity=True,
+             compression=None, map_size=None, map_growth=0, readonly=False):
+        '''
+        Open the cache in cachedir.
+        Setting sync and metasync to False avoids an fsync() on every commit, which
+        makes bulk writes a lot faster. In that case, sync() has to be called
+        explicitly when a stage of work is completed. If the cache was not synced
+        properly before (e.g. due to a crash), its integrity is checked first.
+        The compression can be "zstd", "zlib" or "none". By default, zstd is used
+        if it is available.
+        If map_growth is set, the map is grown by that many bytes whenever it
+        is full, instead of failing the write.
+        A cache opened with readonly set is not modified in any way, it is not
+        upgraded or checked, and writing to it fails.
+        '''
         self.cache_dir = cachedir
+        if map_size:
+            self._map_size = int(map_size)
+        self._map_growth = int(map_growth)
+        self._sync = sync
+        self._metasync = metasync
+        self._writemap = writemap
+        self._readahead = readahead
+
+        if not compression:
+            compression = "zstd" if zstd else "zlib"
+        if compression == "zstd" and not zstd:
+            log.warning("The zstandard module is not available, falling back to zlib compression.")
+            compression = "zlib"
+        if compression not in ["zstd", "zlib", "none"]:
+            log.error("Unknown cache compression: %s" % (compression))
+            return False
+        self._compression = compression
+        self._readonly = readonly
+
+        if readonly:
+            try:
+                self._open_env()
+            except lmdb.Error as e:
+                log.error("Could not open the cache: %s" % (str(e)))
+                return False
+            if os.path.exists(self._get_unclean_marker()):
+                log.warning("Cache was not shut down cleanly, its data may be inconsistent.")
+            return True
+
+        unclean = os.path.exists(self._get_unclean_marker())
+        self._open_env()
+
+        with self._begin(db=self._metadb) as txn:
+            has_gid_index = txn.get(b'gid-index') != None
+        if not has_gid_index:
+            self._build_gid_index()
+        with self._begin(db=self._metadb) as txn:
+            has_cpt_info = txn.get(b'cpt-info') != None
+        if not has_cpt_info:
+            self._build_cpt_info()
+        with self._begin(db=self._metadb) as txn:
+            has_fragments = txn.get(b'fragments') != None
+        if not has_fragments:
+            self._build_fragments()
+        with self._begin(db=self._metadb) as txn:
+            icons_version = txn.get(b'icon-manifest')
+        if icons_version != b'2':
+            # the icon manifest used to lack the component the icons are stored in,
+            # it is filled again when it is needed
+            def clear_icons(txn):
+                txn.drop(self._iconsdb, delete=False)
+                txn.put(b'icon-manifest', b'2', db=self._metadb)
+            self._write(clear_icons)
+
+        if unclean and check_integrity:
+            log.warning("Cache was not shut down cleanly, checking its integrity.")
+            if not self.check_integrity():
+                self.close()
+                return False
+            self.sync()
+
+        if self._compression == "zstd" and not self.get_compression_dict_id():
+            # no compression dictionary yet, try to create one from what we have
+            self.train_compression_dict()
+
+        # don't leave the cache marked as unclean due to the changes above
+        if self._unclean:
+            self.sync()
+
+        return True
+
+    def sync(self):
+        '''
+        Flush all data to disk. Needs to be called at the end of
+        a stage if the cache was opened with sync disabled.
+        '''
+        if not self._opened:
+            return
+        self._dbenv.sync(True)
+        marker = self._get_unclean_marker()
+        if os.path.exists(marker):
+            os.remove(marker)
+        self._unclean = False
+
+    def _build_gid_index(self):
+        '''
+        Create the global-id to package index for caches
+        which were created without it.
+        '''
+        log.info("Building component reference index.")
+        def build_index(txn):
+            for pkgid, value in txn.cursor(db=self._pkgdb):
+                for gid in self._gids_from_pkg_value(value):
+                    self._ref_gid(txn, gid, bytes(pkgid))
+            for gid, value in txn.cursor(db=self._datadb):
+                if txn.get(gid, db=self._gidpkgdb) == None:
+                    txn.put(gid, b'', db=self._orphansdb)
+            txn.put(b'gid-index', b'1', db=self._metadb)
+        self._write(build_index)
+
+    def _build_cpt_info(self):
+        '''
+        Store the component information returned by get_cpt_info()
+        for components which were cached before it existed.
+        '''
+        log.info("Building component information index.")
+        def build_info(txn):
+            for gid, value in txn.cursor(db=self._datadb):
+                if txn.get(gid, db=self._cptinfodb) != None:
+                    continue
+                mdata = str(self._decompress_value(value), 'utf-8')
+                txn.put(bytes(gid), self._cpt_info_from_metadata(mdata), db=self._cptinfodb)
+            txn.put(b'cpt-info', b'1', db=self._metadb)
+        self._write(build_info)
+
+    def _build_fragments(self):
+        '''
+        Store the export fragments of packages which were
+        cached before we had them.
+        '''
+        log.info("Building export fragments.")
+        def build_fragments(txn):
+            for pkgid, value in txn.cursor(db=self._pkgdb):
+                key = b'd/' + bytes(pkgid)
+                gids = self._gids_from_pkg_value(value)
+                if not gids or txn.get(key, db=self._fragmentsdb) != None:
+                    continue
+                mdata = [self._decompress_value(txn.get(gid, db=self._datadb) or b'') for gid in gids]
+                txn.put(key, _make_fragment(b''.join(mdata)), db=self._fragmentsdb)
+            for pkgid, value in txn.cursor(db=self._hintsdb):
+                key = b'h/' + bytes(pkgid)
+                if txn.get(key, db=self._fragmentsdb) != None:
+                    continue
+                hints = self._decompress_value(value)
+                if hints:
+                    txn.put(key, _make_fragment(hints), db=self._fragmentsdb)
+            txn.put(b'fragments', b'1', db=self._metadb)
+        self._write(build_fragments)
+
+    def check_integrity(self):
+        '''
+        Read all data in the cache and drop packages which reference
+        components that went missing.
+        Returns False if the database is damaged beyond repair.
+        '''
+        broken_pkgs = list()
+        unreferenced_gids = list()
+        try:
+            with self._begin() as txn:
+                for db in [self._hintsdb, self._datadb, self._metadb]:
+                    for key, value in txn.cursor(db=db):
+                        pass
+                for pkgid, value in txn.cursor(db=self._pkgdb):
+                    if value == b'ignore' or value == b'seen':
+                        continue
+                    for gid in str(value, 'utf-8').split("\n"):
+                        if txn.get(tobytes(gid), db=self._datadb) == None:
+                            broken_pkgs.append(pkgid)
+                            break
+                for gid, value in txn.cursor(db=self._datadb):
+                    if txn.get(gid, db=self._gidpkgdb) == None:
+                        unreferenced_gids.append(gid)
+        except lmdb.Error as e:
+            log.error("The cache is damaged and needs to be rebuilt: %s" % (str(e)))
+            return False
+
+        for pkgid in broken_pkgs:
+            log.warning("Package %s references missing metadata, it will be processed again." % (str(pkgid, 'utf-8')))
+            self.remove_package(pkgid)
+        if broken_pkgs:
+            self.remove_index_snapshots()
+        # ensure the next cleanup run drops components nobody references
+        def mark_orphans(txn):
+            for gid in unreferenced_gids:
+                txn.put(gid, b'')
+        self._write(mark_orphans, db=self._orphansdb)
         return True
 
     def close(self):
@@ -65,41 +395,302 @@ class DataCache:
         self._pkgdb = None
         self._hintsdb = None
         self._datadb = None
+        self._metadb = None
+        self._gidpkgdb = None
+        self._orphansdb = None
+        self._cptinfodb = None
+        self._snapshotsdb = None
+        self._fragmentsdb = None
+        self._iconsdb = None
+        self._highlightdb = None
         self._dbenv = None
         self._opened = False
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+        # compression contexts can't be shared with other processes
+        self._zcompressor = None
+        self._zdecompressors = dict()
+
+    def get_compression_dict_id(self):
+        with self._begin(db=self._metadb) as txn:
+            dict_id = txn.get(b'zstd-dict')
+            if not dict_id:
+                return None
+            return str(dict_id, 'utf-8')
+
+    def _get_zstd_compressor(self):
+        if self._zcompressor:
+            return self._zcompressor
+
+        zdict = None
+        with self._begin(db=self._metadb) as txn:
+            dict_id = txn.get(b'zstd-dict')
+            if dict_id:
+                zdict = zstd.ZstdCompressionDict(txn.get(b'zstd-dict/' + dict_id))
+        self._zcompressor = zstd.ZstdCompressor(level=9, dict_data=zdict)
+        return self._zcompressor
+
+    def _get_zstd_decompressor(self, data):
+        dict_id = zstd.get_frame_parameters(data).dict_id
+        dctx = self._zdecompressors.get(dict_id)
+        if dctx:
+            return dctx
+
+        zdict = None
+        if dict_id:
+            with self._begin(db=self._metadb) as txn:
+                zdict = zstd.ZstdCompressionDict(txn.get(tobytes("zstd-dict/%i" % (dict_id))))
+        dctx = zstd.ZstdDecompressor(dict_data=zdict)
+        self._zdecompressors[dict_id] = dctx
+        return dctx
+
+    def _compress_value(self, data):
+        data = tobytes(data)
+        if len(data) < _COMPRESS_MIN_SIZE:
+            return data
+        if self._compression == "zstd":
+            return _VALUE_ZSTD + self._get_zstd_compressor().compress(data)
+        if self._compression == "zlib":
+            return _VALUE_ZLIB + zlib.compress(data, 9)
+        return data
+
+    def _decompress_value(self, value):
+        value = bytes(value)
+        if value.startswith(_VALUE_ZSTD):
+            if not zstd:
+                raise Exception("Cached value is compressed with zstd, but the zstandard module is not available.")
+            data = value[len(_VALUE_ZSTD):]
+            return self._get_zstd_decompressor(data).decompress(data)
+        if value.startswith(_VALUE_ZLIB):
+            return zlib.decompress(value[len(_VALUE_ZLIB):])
+        return value
+
+    def train_compression_dict(self):
+        '''
+        Train a zstd dictionary on the cached metadata and hints, which is
+        used to compress all new values.
+        Returns False if there is not enough data to train on yet.
+        '''
+        if not zstd:
+            return False
+
+        samples = list()
+        with self._begin() as txn:
+            for db in [self._datadb, self._hintsdb]:
+                for key, value in txn.cursor(db=db):
+                    if len(samples) >= _ZSTD_DICT_MAX_SAMPLES:
+                        break
+                    if value:
+                        samples.append(self._decompress_value(value))
+        if len(samples) < _ZSTD_DICT_MIN_SAMPLES:
+            return False
+
+        try:
+            zdict = zstd.train_dictionary(_ZSTD_DICT_SIZE, samples)
+        except zstd.ZstdError as e:
+            log.warning("Unable to train compression dictionary: %s" % (str(e)))
+            return False
+        dict_id = tobytes(str(zdict.dict_id()))
+
+        def store_dict(txn):
+            txn.put(b'zstd-dict/' + dict_id, zdict.as_bytes())
+            txn.put(b'zstd-dict', dict_id)
+        self._write(store_dict, db=self._metadb)
+        self._zcompressor = None
+        log.info("Trained new compression dictionary on %i cached values." % (len(samples)))
+        return True
+
+    def compact(self):
+        '''
+        Rewrite the database without its free pages, and replace the current
+        one with the compacted copy.
+        Returns None if the cache is in use by other processes, as they would
+        keep using the old database file.
+        '''
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log.error("The cache is in use by another process, can not compact it.")
+            return None
 
-    def reopen(self):
+        compact_dir = os.path.normpath(self.cache_dir) + ".compact"
+        shutil.rmtree(compact_dir, ignore_errors=True)
+        os.makedirs(compact_dir)
+
+        data_fname = os.path.join(self.cache_dir, "data.mdb")
+        compact_fname = os.path.join(compact_dir, "data.mdb")
+        self._dbenv.copy(compact_dir, compact=True)
+        with open(compact_fname, 'rb') as f:
+            os.fsync(f.fileno())
+        old_size = os.path.getsize(data_fname)
+
+        # keep the exclusive lock until the new database is in place
+        lock_file = self._lock_file
+        self._lock_file = None
+        self.close()
+        os.replace(compact_fname, data_fname)
+        shutil.rmtree(compact_dir)
+        lock_file.close()
+        self._open_env()
+
+        return (old_size, os.path.getsize(data_fname))
+
+    def reopen(self, readonly=None):
+        '''
+        Open the cache again in this process, e.g. in a pool worker.
+        If readonly is set, it replaces the mode the cache was opened with.
+        '''
+        if readonly is not None:
+            self._readonly = readonly
         if self._opened:
             return
         self.close()
-        self.open(self.cache_dir)
+        self._open_env()
 
     def metadata_exists(self, global_id):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb) as txn:
+        with self._begin(db=self._datadb) as txn:
             return txn.get(gid) != None
 
     def get_metadata(self, global_id):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb) as dtxn:
+        with self._begin(db=self._datadb) as dtxn:
                 d = dtxn.get(tobytes(gid))
                 if not d:
                     return None
-                return str(d, 'utf-8')
+                return str(self._decompress_value(d), 'utf-8')
 
     def set_metadata(self, global_id, yaml_data):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb, write=True) as txn:
-            txn.put(gid, tobytes(yaml_data))
+        value = self._compress_value(yaml_data)
+        def put_metadata(txn):
+            txn.put(gid, value)
+        self._write(put_metadata, db=self._datadb)
+
+    def _gids_from_pkg_value(self, value):
+        if not value or value == b'ignore' or value == b'seen':
+            return list()
+        return bytes(value).split(b"\n")
+
+    def _ref_gid(self, txn, gid, pkgid):
+        pkgids = txn.get(gid, db=self._gidpkgdb)
+        if pkgids:
+            pkgids = bytes(pkgids).split(b"\n")
+            if pkgid in pkgids:
+                return
+            pkgids.append(pkgid)
+        else:
+            pkgids = [pkgid]
+            txn.delete(gid, db=self._orphansdb)
+        txn.put(gid, b"\n".join(pkgids), db=self._gidpkgdb)
+
+    def _unref_gid(self, txn, gid, pkgid):
+        pkgids = txn.get(gid, db=self._gidpkgdb)
+        if not pkgids:
+            return
+        pkgids = bytes(pkgids).split(b"\n")
+        if pkgid in pkgids:
+            pkgids.remove(pkgid)
+        if pkgids:
+            txn.put(gid, b"\n".join(pkgids), db=self._gidpkgdb)
+        else:
+            # nothing references this component anymore, schedule it for removal
+            txn.delete(gid, db=self._gidpkgdb)
+            txn.put(gid, b'', db=self._orphansdb)
+
+    def _set_package_value(self, txn, pkgid, value):
+        '''
+        Set the value of a package entry, and update the references
+        to its components accordingly.
+        '''
+        old_gids = set(self._gids_from_pkg_value(txn.get(pkgid, db=self._pkgdb)))
+        new_gids = set(self._gids_from_pkg_value(value))
+        for gid in old_gids - new_gids:
+            self._unref_gid(txn, gid, pkgid)
+        for gid in new_gids - old_gids:
+            self._ref_gid(txn, gid, pkgid)
+        if value == None:
+            txn.delete(pkgid, db=self._pkgdb)
+        else:
+            txn.put(pkgid, value, db=self._pkgdb)
+
+    def get_cpt_info(self, global_id):
+        '''
+        Get a dictionary with the package name, component-id, type and
+        cached icon of the component with the given global-id, or None
+        if it doesn't exist.
+        '''
+        gid = tobytes(global_id)
+        with self._begin(db=self._cptinfodb) as txn:
+            info = self._parse_cpt_info(txn.get(gid))
+        if not info:
+            # caches which were not upgraded by open() yet need to look at the metadata
+            mdata = self.get_metadata(global_id)
+            if not mdata:
+                return None
+            return self._parse_cpt_info(self._cpt_info_from_metadata(mdata))
+
+        return info
+
+    def _cpt_info_from_metadata(self, mdata):
+        mdata = yaml.safe_load(mdata)
+        icon = mdata.get('Icon')
+        if isinstance(icon, dict):
+            icon = icon.get('cached')
+        if not isinstance(icon, str):
+            icon = ""
+        info = [str(mdata.get(key) or "") for key in ['Package', 'ID', 'Type']]
+        return bytes("\t".join(info + [icon]), 'utf-8')
+
+    def _parse_cpt_info(self, value):
+        if not value:
+            return None
+        info = str(value, 'utf-8').split("\t")
+        if len(info) < 4:
+            return None
+        return {'package': info[0], 'cid': info[1], 'type': info[2], 'icon': info[3] or None}
+
+    def get_package_records(self, pkgids):
+        '''
+        Get the hints and components of the given packages, read in a single
+        transaction. Returns a list of (pkgid, hints, cpt_infos) tuples for the
+        packages which have any, with cpt_infos mapping the global-ids of the
+        package's components to the data returned by get_cpt_info().
+        '''
+        records = list()
+        incomplete = list()
+        with self._begin() as txn:
+            for pkgid in pkgids:
+                key = tobytes(pkgid)
+                hints = txn.get(key, db=self._hintsdb)
+                if hints:
+                    hints = str(self._decompress_value(hints), 'utf-8')
+                cpt_infos = dict()
+                for gid in self._gids_from_pkg_value(txn.get(key, db=self._pkgdb)):
+                    info = self._parse_cpt_info(txn.get(gid, db=self._cptinfodb))
+                    gid = str(gid, 'utf-8')
+                    if not info:
+                        incomplete.append((gid, cpt_infos))
+                    cpt_infos[gid] = info
+                if hints or cpt_infos:
+                    records.append((pkgid, hints, cpt_infos))
+
+        for gid, cpt_infos in incomplete:
+            cpt_infos[gid] = self.get_cpt_info(gid)
+        return records
 
     def set_package_ignore(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-            txn.put(pkgid, b'ignore')
+        def put_ignore(txn):
+            self._set_package_value(txn, pkgid, b'ignore')
+            txn.delete(b'd/' + pkgid, db=self._fragmentsdb)
+        self._write(put_ignore)
 
     def get_cpt_gids_for_pkg(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
+        with self._begin(db=self._pkgdb) as txn:
             cs_str = txn.get(pkgid)
             if not cs_str:
                 return None
@@ -131,46 +722,101 @@ class DataCache:
         pkgid = tobytes(pkgid)
 
         gids = list()
+        new_cpts = list()
+        data_str = ""
         hints_str = ""
         for cpt in cpts:
             # check for ignore-reasons first, to avoid a database query
             if not cpt.has_ignore_reason():
-                if self.metadata_exists(cpt.global_id):
+                md_yaml = self.get_metadata(cpt.global_id)
+                if md_yaml:
                     gids.append(cpt.global_id)
+                    data_str += md_yaml
                 else:
                     # get the metadata in YAML format
                     md_yaml = cpt.to_yaml_doc()
                     # we need to check for ignore reasons again, since generating
                     # the YAML doc may have raised more errors
                     if not cpt.has_ignore_reason():
-                        self.set_metadata(cpt.global_id, md_yaml)
+                        new_cpts.append((cpt, self._compress_value(md_yaml)))
                         gids.append(cpt.global_id)
+                        data_str += md_yaml
 
             hints_yml = cpt.get_hints_yaml()
             if hints_yml:
                 hints_str += hints_yml
 
-        self.set_hints(pkgid, hints_str)
-        if gids:
-            with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-                txn.put(pkgid, bytes("\n".join(gids), 'utf-8'))
-        elif hints_str:
-            # we need to set some value for this package, to show that we've seen it
-            with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-                txn.put(pkgid, b'seen')
+        hints_value = self._compress_value(hints_str)
+        data_fragment = _make_fragment(data_str) if data_str else None
+        hints_fragment = _make_fragment(hints_str) if hints_str else None
+        def put_components(txn):
+            for cpt, value in new_cpts:
+                gid = tobytes(cpt.global_id)
+                txn.put(gid, value, db=self._datadb)
+                info = "\t".join([cpt.pkgname, cpt.cid, cpt.kind or "", cpt.icon or ""])
+                txn.put(gid, bytes(info, 'utf-8'), db=self._cptinfodb)
+            txn.put(pkgid, hints_value, db=self._hintsdb)
+            self._put_fragments(txn, pkgid, data_fragment, hints_fragment)
+            if gids:
+                self._set_package_value(txn, pkgid, bytes("\n".join(gids), 'utf-8'))
+            elif hints_str:
+                # we need to set some value for this package, to show that we've seen it
+                self._set_package_value(txn, pkgid, b'seen')
+        self._write(put_components)
 
     def get_hints(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._hintsdb) as txn:
+        with self._begin(db=self._hintsdb) as txn:
             hints = txn.get(pkgid)
             if hints:
-                hints = str(hints, 'utf-8')
+                hints = str(self._decompress_value(hints), 'utf-8')
             return hints
 
     def set_hints(self, pkgid, hints_yml):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._hintsdb, write=True) as txn:
-            txn.put(pkgid, tobytes(hints_yml))
+        value = self._compress_value(hints_yml)
+        fragment = _make_fragment(hints_yml) if hints_yml else None
+        def put_hints(txn):
+            txn.put(pkgid, value, db=self._hintsdb)
+            if fragment:
+                txn.put(b'h/' + pkgid, fragment, db=self._fragmentsdb)
+            else:
+                txn.delete(b'h/' + pkgid, db=self._fragmentsdb)
+        self._write(put_hints)
+
+    def _put_fragments(self, txn, pkgid, data_fragment, hints_fragment):
+        for key, fragment in [(b'd/' + pkgid, data_fragment), (b'h/' + pkgid, hints_fragment)]:
+            if fragment:
+                txn.put(key, fragment, db=self._fragmentsdb)
+            else:
+                txn.delete(key, db=self._fragmentsdb)
+
+    def get_export_fragments(self, pkgids):
+        '''
+        Get the component global-ids and the data and hints fragments of
+        the given packages, all read in a single transaction.
+        Returns a list of (pkgid, gids, data_fragment, hints_fragment) tuples
+        for all packages which have data or hints.
+        '''
+        entries = list()
+        with self._begin() as txn:
+            for pkgid in pkgids:
+                key = tobytes(pkgid)
+                gids = [str(gid, 'utf-8') for gid in self._gids_from_pkg_value(txn.get(key, db=self._pkgdb))]
+                data = None
+                if gids:
+                    data = txn.get(b'd/' + key, db=self._fragmentsdb)
+                    if not data:
+                        # caches which were not upgraded by open() yet
+                        mdata = [self._decompress_value(txn.get(tobytes(gid), db=self._datadb) or b'') for gid in gids]
+                        data = _make_fragment(b''.join(mdata))
+                hints = txn.get(b'h/' + key, db=self._fragmentsdb)
+                if not hints:
+                    hints = txn.get(key, db=self._hintsdb)
+                    hints = _make_fragment(self._decompress_value(hints)) if hints else None
+                if gids or hints:
+                    entries.append((pkgid, gids, bytes(data) if data else None, bytes(hints) if hints else None))
+        return entries
 
     def _cleanup_empty_dirs(self, d):
         parent = os.path.abspath(os.path.join(d, os.pardir))
@@ -187,26 +833,39 @@ class DataCache:
     def remove_package(self, pkgid):
         log.debug("Dropping package: %s" % (pkgid))
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb, write=True) as pktxn:
-            pktxn.delete(pkgid)
-        with self._dbenv.begin(db=self._hintsdb, write=True) as htxn:
-            htxn.delete(pkgid)
+        def drop_package(txn):
+            self._set_package_value(txn, pkgid, None)
+            txn.delete(pkgid, db=self._hintsdb)
+            self._put_fragments(txn, pkgid, None, None)
+        self._write(drop_package)
 
     def is_ignored(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
+        with self._begin(db=self._pkgdb) as txn:
             return txn.get(pkgid) == b'ignore'
 
     def package_exists(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
+        with self._begin(db=self._pkgdb) as txn:
             return txn.get(pkgid) != None
 
+    def count_existing_packages(self, pkgids):
+        '''
+        Count how many of the given packages are in the cache,
+        in a single transaction.
+        '''
+        count = 0
+        with self._begin(db=self._pkgdb) as txn:
+            for pkgid in pkgids:
+                if txn.get(tobytes(pkgid)) != None:
+                    count += 1
+        return count
+
     def get_packages_not_in_set(self, pkgset):
         res = set()
         if not pkgset:
             pkgset = set()
-        with self._dbenv.begin(db=self._pkgdb) as txn:
+        with self._begin(db=self._pkgdb) as txn:
             cursor = txn.cursor()
             for key, value in cursor:
                 if not str(key, 'utf-8') in pkgset:
@@ -214,39 +873,248 @@ class DataCache:
         return res
 
     def remove_orphaned_components(self):
-        gid_pkg = dict()
+        '''
+        Drop all components which are no longer referenced by any package,
+        together with their media.
+        Returns a list of the media directories which were removed.
+        '''
+        removed_dirs = list()
+        with self._begin(db=self._orphansdb) as txn:
+            orphans = [bytes(gid) for gid, value in txn.cursor()]
+        if not orphans:
+            return removed_dirs
 
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            cursor = txn.cursor()
-            for key, value in cursor:
-                if not value or value == b'ignore' or value == b'seen':
+        # drop the components from the db
+        def drop_components(txn):
+            dropped = list()
+            for gid in orphans:
+                txn.delete(gid, db=self._orphansdb)
+                # the component might have been referenced again in the meantime
+                if txn.get(gid, db=self._gidpkgdb) != None:
+                    continue
+                txn.delete(gid, db=self._datadb)
+                txn.delete(gid, db=self._cptinfodb)
+                txn.delete(gid, db=self._iconsdb)
+                txn.delete(gid, db=self._highlightdb)
+                dropped.append(gid)
+            return dropped
+        dropped = self._write(drop_components)
+
+        # the media of a component is stored in a directory per archive component
+        media_cpt_dirs = list()
+        if os.path.isdir(self.media_dir):
+            media_cpt_dirs = [os.path.join(self.media_dir, d) for d in os.listdir(self.media_dir)]
+
+        # remove the media of the components which were dropped, only once their
+        # removal is committed, so we never drop media which is still in use
+        for gid in dropped:
+            gid_str = str(gid, 'utf-8')
+            for cpt_dir in media_cpt_dirs:
+                gid_dir = os.path.join(cpt_dir, gid_str)
+                if not os.path.isdir(gid_dir):
                     continue
-                value = str(value, 'utf-8')
-                gids = value.split("\n")
-                for gid in gids:
-                    if not gid_pkg.get(gid):
-                        gid_pkg[gid] = list()
-                    gid_pkg[gid].append(key)
-
-        # remove the media and component data, if component is orphaned
-        with self._dbenv.begin(db=self._datadb) as dtxn:
-            cursor = dtxn.cursor()
-            for gid, yaml in cursor:
-                gid = str(gid, 'utf-8')
-
-                # Check if we have a package which is still referencing this component
-                pkgs = gid_pkg.get(gid)
-                if pkgs:
+                shutil.rmtree(gid_dir)
+                removed_dirs.append(gid_dir)
+                log.info("Expired media: %s" % (gid_str))
+                # remove possibly empty directories
+                self._cleanup_empty_dirs(gid_dir)
+
+        return removed_dirs
+
+    def get_highlighted_metadata(self, global_id, version):
+        '''
+        Get the syntax-highlighted metadata of a component, or None if it
+        was not stored yet or was created by a different version of the highlighter.
+        '''
+        with self._begin(db=self._highlightdb) as txn:
+            value = txn.get(tobytes(global_id))
+        if not value:
+            return None
+        value = str(self._decompress_value(value), 'utf-8')
+        value_version, html = value.split("\n", 1)
+        if value_version != version:
+            return None
+        return html
+
+    def set_highlighted_metadata(self, entries, version):
+        '''
+        Store the syntax-highlighted metadata of components,
+        given as dictionary of global-id -> HTML.
+        '''
+        values = [(tobytes(gid), self._compress_value(version + "\n" + html)) for gid, html in entries.items()]
+        def put_highlighted(txn):
+            for gid, value in values:
+                txn.put(gid, value)
+        self._write(put_highlighted, db=self._highlightdb)
+
+    def get_icon_manifest(self, component, global_ids):
+        '''
+        Get the icons of the given components, as a dictionary of
+        global-id -> list of (size, filename, path) tuples.
+        Components which are not in the manifest yet are looked up
+        in the media directory once, and added to it. Their media is
+        stored with the archive component they were first found in, which
+        is looked at first, followed by all others.
+        '''
+        manifest = dict()
+        missing = list()
+        with self._begin(db=self._iconsdb) as txn:
+            for gid in global_ids:
+                value = txn.get(tobytes(gid))
+                if value == None:
+                    missing.append(gid)
+                elif value:
+                    manifest[gid] = str(value, 'utf-8').split("\n")
+                else:
+                    manifest[gid] = list()
+
+        if missing:
+            media_components = list()
+            if os.path.isdir(self.media_dir):
+                media_components = sorted(os.listdir(self.media_dir))
+            if component in media_components:
+                media_components.remove(component)
+            media_components.insert(0, component)
+
+            for gid in missing:
+                icons = list()
+                for media_component in media_components:
+                    icons_dir = os.path.join(self.media_dir, media_component, gid, "icons")
+                    if not os.path.isdir(icons_dir):
+                        continue
+                    for size_entry in os.scandir(icons_dir):
+                        if not size_entry.is_dir():
+                            continue
+                        for entry in os.scandir(size_entry.path):
+                            if entry.name.endswith(".png"):
+                                icons.append("%s/%s/%s" % (media_component, size_entry.name, entry.name))
+                    break
+                icons.sort()
+                manifest[gid] = icons
+
+            def put_icons(txn):
+                for gid in missing:
+                    txn.put(tobytes(gid), bytes("\n".join(manifest[gid]), 'utf-8'))
+            self._write(put_icons, db=self._iconsdb)
+
+        res = dict()
+        for gid, entries in manifest.items():
+            res[gid] = list()
+            for entry in entries:
+                media_component, size, fname = entry.split("/", 2)
+                res[gid].append((size, fname, os.path.join(self.media_dir, media_component, gid, "icons", size, fname)))
+        return res
+
+    def get_stats(self):
+        '''
+        Collect statistics about the contents of the cache and
+        its disk usage, as a dictionary.
+        '''
+        stats = dict()
+
+        db_stats = dict()
+        with self._begin() as txn:
+            for name, db in self._get_databases().items():
+                if not db:
                     continue
+                dbs = txn.stat(db)
+                key_bytes = 0
+                value_bytes = 0
+                for key, value in txn.cursor(db=db):
+                    key_bytes += len(key)
+                    value_bytes += len(value)
+                db_stats[name] = {'entries': dbs['entries'],
+                                  'key_bytes': key_bytes,
+                                  'value_bytes': value_bytes,
+                                  'depth': dbs['depth'],
+                                  'branch_pages': dbs['branch_pages'],
+                                  'leaf_pages': dbs['leaf_pages'],
+                                  'overflow_pages': dbs['overflow_pages']}
+
+            pkg_stats = {'total': 0, 'ignored': 0, 'seen': 0, 'with_components': 0}
+            for key, value in txn.cursor(db=self._pkgdb):
+                pkg_stats['total'] += 1
+                if value == b'ignore':
+                    pkg_stats['ignored'] += 1
+                elif value == b'seen':
+                    pkg_stats['seen'] += 1
+                else:
+                    pkg_stats['with_components'] += 1
+
+            orphans = list()
+            if self._orphansdb:
+                orphans = [str(gid, 'utf-8') for gid, value in txn.cursor(db=self._orphansdb)]
+
+        stats['databases'] = db_stats
+        stats['packages'] = pkg_stats
+
+        env_info = self._dbenv.info()
+        env_stat = self._dbenv.stat()
+        page_size = env_stat['psize']
+        used_bytes = (env_info['last_pgno'] + 1) * page_size
+        stats['map'] = {'map_size': env_info['map_size'],
+                        'page_size': page_size,
+                        'used_pages': env_info['last_pgno'] + 1,
+                        'used_bytes': used_bytes,
+                        'fill': used_bytes / env_info['map_size'],
+                        'file_bytes': os.path.getsize(os.path.join(self.cache_dir, "data.mdb"))}
+
+        # media of components which are scheduled for removal
+        media_bytes = 0
+        if os.path.isdir(self.media_dir):
+            for cpt_dir in os.listdir(self.media_dir):
+                for gid in orphans:
+                    gid_dir = os.path.join(self.media_dir, cpt_dir, gid)
+                    for root, dirs, files in os.walk(gid_dir):
+                        for fname in files:
+                            media_bytes += os.path.getsize(os.path.join(root, fname))
+        stats['orphaned'] = {'components': len(orphans), 'media_bytes': media_bytes}
+
+        return stats
+
+    def get_index_snapshot(self, key):
+        '''
+        Get the hash of the package index with the given key and the set of
+        package-ids which were processed from it, as set by set_index_snapshot().
+        '''
+        with self._begin(db=self._snapshotsdb) as txn:
+            value = txn.get(tobytes(key))
+            if not value:
+                return (None, set())
+            value = str(self._decompress_value(value), 'utf-8')
+        index_hash, pkgids = value.split("\n", 1)
+        return (index_hash, set(pkgids.split("\n")))
+
+    def set_index_snapshot(self, key, index_hash, pkgids):
+        value = self._compress_value("%s\n%s" % (index_hash, "\n".join(pkgids)))
+        key = tobytes(key)
+        def put_snapshot(txn):
+            txn.put(key, value)
+        self._write(put_snapshot, db=self._snapshotsdb)
+
+    def remove_index_snapshots(self, prefix=""):
+        '''
+        Drop all package index snapshots with keys starting with prefix.
+        '''
+        prefix = tobytes(prefix)
+        def drop_snapshots(txn):
+            keys = [bytes(key) for key, value in txn.cursor() if bytes(key).startswith(prefix)]
+            for key in keys:
+                txn.delete(key)
+        self._write(drop_snapshots, db=self._snapshotsdb)
+
+    def get_export_hash(self, fname):
+        '''
+        Get the hash of the data which was last written to the exported file fname.
+        '''
+        with self._begin(db=self._metadb) as txn:
+            value = txn.get(tobytes("export-hash/%s" % (fname)))
+            if not value:
+                return None
+            return str(value, 'utf-8')
 
-                # drop cached media
-                dirs = glob.glob(os.path.join(self.media_dir, "*", gid))
-                if dirs:
-                    shutil.rmtree(dirs[0])
-                    log.info("Expired media: %s" % (gid))
-                    # remove possibly empty directories
-                    self._cleanup_empty_dirs(dirs[0])
-
-                # drop component from db
-                with self._dbenv.begin(db=self._datadb, write=True) as dtxn:
-                    dtxn.delete(tobytes(gid))
+    def set_export_hash(self, fname, data_hash):
+        key = tobytes("export-hash/%s" % (fname))
+        def put_hash(txn):
+            txn.put(key, tobytes(data_hash))
+        self._write(put_hash, db=self._metadb)
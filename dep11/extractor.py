@@ -20,7 +20,6 @@ import os
 import fnmatch
 import urllib.request
 import ssl
-import yaml
 from apt_inst import DebFile
 from io import BytesIO
 
@@ -53,6 +52,8 @@ class MetadataExtractor:
         self._export_dir = dcache.media_dir
         self._dcache = dcache
         self.write_to_cache = True
+        # optional ExportChangeLog to record the media we write
+        self.change_log = None
 
         self._icon_ext_allowed = ('.png', '.svg', '.xcf', '.gif', '.svgz', '.jpg')
 
@@ -591,10 +592,9 @@ class MetadataExtractor:
             # To account for packages which change their package name, we
             # also need to check if the package this component is associated
             # with matches ours.
-            existing_mdata = self._dcache.get_metadata(cpt.global_id)
-            if existing_mdata:
-                s = "Package: %s\n" % (pkgname)
-                if s in existing_mdata:
+            existing_info = self._dcache.get_cpt_info(cpt.global_id)
+            if existing_info:
+                if existing_info['package'] == pkgname:
                     continue
                 else:
                     # the exact same metadata exists in a different package already, raise ab error.
@@ -602,8 +602,7 @@ class MetadataExtractor:
                     # but with the *same ID* exists. This kind of issue can only be catched when listing all IDs per
                     # suite/acomponent combination and checking for dupes (we do that in the DEP-11 validator and display
                     # the result prominently on the HTML pages)
-                    ecpt = yaml.safe_load(existing_mdata)
-                    cpt.add_hint("metainfo-duplicate-id", {'cid': cpt.cid, 'pkgname': ecpt.get('Package', '')})
+                    cpt.add_hint("metainfo-duplicate-id", {'cid': cpt.cid, 'pkgname': existing_info['package']})
                     continue
 
             self._fetch_icon(cpt, export_path, pkg_fname, filelist)
@@ -612,6 +611,11 @@ class MetadataExtractor:
             else:
                 self._fetch_screenshots(cpt, export_path)
 
+            if self.change_log:
+                cpt_media_dir = os.path.join(export_path, cpt.global_id)
+                if os.path.isdir(cpt_media_dir):
+                    self.change_log.add_changed(cpt_media_dir)
+
         # write data to cache
         if self.write_to_cache:
             # write the components we found to the cache
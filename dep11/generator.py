@@ -21,21 +21,23 @@ import yaml
 import apt_pkg
 import gzip
 import tarfile
-import glob
 import shutil
 import time
+import json
+import hashlib
 import traceback
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from argparse import ArgumentParser
 import multiprocessing as mp
 import logging as log
 
-from dep11 import MetadataExtractor, DataCache, build_cpt_global_id
-from dep11.component import DEP11Component, get_dep11_header, dict_to_dep11_yaml
+from dep11 import MetadataExtractor, DataCache
+from dep11.component import DEP11Component, get_dep11_header
 from dep11.iconfinder import ContentsListIconFinder
-from dep11.utils import read_packages_dict_from_file
+from dep11.utils import read_packages_dict_from_file, set_packages_index_cache_dir
 from dep11.hints import get_hint_tag_info
 from dep11.validate import DEP11Validator
+from dep11.publish import ExportChangeLog, publish_export
 
 try:
     import pygments
@@ -44,6 +46,9 @@ try:
 except:
     pygments = None
 
+# change this if the highlighted metadata needs to be generated again
+_HIGHLIGHT_FORMAT_VERSION = "1"
+
 def safe_move_file(old_fname, new_fname):
     if not os.path.isfile(old_fname):
         return
@@ -56,17 +61,6 @@ def get_pkg_id(name, version, arch):
     return "%s/%s/%s" % (name, version, arch)
 
 
-def equal_dicts(d1, d2, ignore_keys):
-    ignored = set(ignore_keys)
-    for k1, v1 in d1.items():
-        if k1 not in ignored and (k1 not in d2 or d2[k1] != v1):
-            return False
-    for k2, v2 in d2.items():
-        if k2 not in ignored and k2 not in d1:
-            return False
-    return True
-
-
 def extract_metadata(mde, sn, pkgname, package_fname, version, arch, pkid):
     # we're now in a new process and can (re)open a LMDB connection
     mde.reopen_cache()
@@ -76,6 +70,198 @@ def extract_metadata(mde, sn, pkgname, package_fname, version, arch, pkid):
     return msgtxt
 
 
+def export_arch_data(cache, dep11_header, pkgids, data_fname, hints_fname, validation_fname):
+    '''
+    Write the DEP-11 data and hints of the given packages to disk,
+    unless the data in the existing files is already the same.
+    The data is validated while it is written, and the result is
+    saved to validation_fname.
+    Returns a status message and a list of (filename, hash) tuples
+    for the files which were written.
+    '''
+    # we're now in a new process and can (re)open a LMDB connection,
+    # only the parent process writes to the cache
+    cache.reopen(readonly=True)
+    try:
+        pkg_entries = cache.get_export_fragments(pkgids)
+
+        # hash what needs to be in the files
+        data_hash = hashlib.sha256(bytes(dep11_header, 'utf-8'))
+        hints_hash = hashlib.sha256()
+        for pkid, gids, data, hints in pkg_entries:
+            if gids:
+                data_hash.update(bytes("\n".join(gids)+"\n", 'utf-8'))
+            if hints:
+                hints_hash.update(hints)
+        data_hash = data_hash.hexdigest()
+        hints_hash = hints_hash.hexdigest()
+
+        write_data = data_hash != cache.get_export_hash(data_fname) or not os.path.isfile(data_fname)
+        write_hints = hints_hash != cache.get_export_hash(hints_fname) or not os.path.isfile(hints_fname)
+    finally:
+        cache.close()
+
+    validator = None
+    if write_data or not os.path.isfile(validation_fname):
+        validator = DEP11Validator()
+        validator.begin_stream()
+        validator.feed(dep11_header)
+
+    written = list()
+    # the cache holds every package's data as separate gzip member, so the files
+    # are written by concatenating those, without compressing anything again
+    if write_data:
+        with open(data_fname+".new", 'wb') as data_f:
+            data_f.write(gzip.compress(bytes(dep11_header, 'utf-8'), 9, mtime=0))
+            for pkid, gids, data, hints in pkg_entries:
+                if data:
+                    data_f.write(data)
+                    validator.feed(str(gzip.decompress(data), 'utf-8'))
+        safe_move_file(data_fname+".new", data_fname)
+        written.append((data_fname, data_hash))
+    elif validator:
+        for pkid, gids, data, hints in pkg_entries:
+            if data:
+                validator.feed(str(gzip.decompress(data), 'utf-8'))
+
+    if validator:
+        valid = validator.end_stream()
+        with open(validation_fname+".new", 'w') as f:
+            json.dump({'file': os.path.basename(data_fname), 'valid': valid, 'issues': validator.issue_list}, f, indent=1)
+        safe_move_file(validation_fname+".new", validation_fname)
+        written.append((validation_fname, data_hash))
+
+    if write_hints:
+        with open(hints_fname+".new", 'wb') as hints_f:
+            # an empty gzip member, so the file is valid even without any hints
+            hints_f.write(gzip.compress(b'', 9, mtime=0))
+            for pkid, gids, data, hints in pkg_entries:
+                if hints:
+                    hints_f.write(hints)
+        safe_move_file(hints_fname+".new", hints_fname)
+        written.append((hints_fname, hints_hash))
+
+    if written:
+        msgtxt = "Exported: %s" % (", ".join([os.path.basename(fname) for fname, h in written]))
+    else:
+        msgtxt = "Unchanged: %s, %s" % (os.path.basename(data_fname), os.path.basename(hints_fname))
+    return (msgtxt, written)
+
+
+def make_icon_tar(tar_fname, tar_hash, icons):
+    '''
+     Generate icons-%(size).tar.gz from a list of (icon name, filename) tuples
+    '''
+    tar = tarfile.open(tar_fname+".new", "w:gz")
+    for icon_name, filename in icons:
+        if not os.path.isfile(filename):
+            log.warning("Icon %s is missing, not adding it to %s." % (filename, os.path.basename(tar_fname)))
+            continue
+        tar.add(filename, arcname=icon_name)
+    tar.close()
+    safe_move_file(tar_fname+".new", tar_fname)
+
+    return ("Created icon tarball %s" % (tar_fname), [(tar_fname, tar_hash)])
+
+
+# the template environment of the current process, see get_template_env()
+_TEMPLATE_ENV = None
+
+# number of pages rendered by one HTML rendering task
+_RENDER_BATCH_SIZE = 200
+
+
+def get_template_env(template_dir, bytecode_cache_dir):
+    '''
+    Get the jinja2 environment of this process, so templates are
+    only loaded and compiled once per process.
+    '''
+    global _TEMPLATE_ENV
+    if _TEMPLATE_ENV and _TEMPLATE_ENV.loader.searchpath == [template_dir]:
+        return _TEMPLATE_ENV
+
+    if not os.path.exists(bytecode_cache_dir):
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+    _TEMPLATE_ENV = Environment(loader=FileSystemLoader(template_dir),
+                                bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir))
+    return _TEMPLATE_ENV
+
+
+def render_pages(template_dir, bytecode_cache_dir, template_globals, pages):
+    '''
+    Render a batch of HTML pages, given as (template name, output path, args, kwargs) tuples.
+    '''
+    j2_env = get_template_env(template_dir, bytecode_cache_dir)
+    for name, out_path, args, kwargs in pages:
+        # create subdirectories if necessary
+        out_dir = os.path.dirname(os.path.realpath(out_path))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
+
+        template = j2_env.get_template(name)
+        content = template.render(*args, **dict(template_globals, **kwargs))
+        write_page(out_path, bytes(content, 'utf-8'))
+
+    return "Rendered %i pages" % (len(pages))
+
+
+def write_page(out_path, content):
+    '''
+    Write a page, and a precompressed copy of it next to it
+    that web servers can deliver directly.
+    '''
+    with open(out_path, 'wb') as f:
+        f.write(content)
+    with open(out_path+".gz", 'wb') as f:
+        f.write(gzip.compress(content, 9, mtime=0))
+
+
+def get_index_letter(name):
+    '''
+    Get the letter of the index page a name is listed on.
+    '''
+    c = name.strip()[:1].lower()
+    if c >= 'a' and c <= 'z':
+        return c
+    if c.isdigit():
+        return "0-9"
+    return "other"
+
+
+def parse_size(value):
+    '''
+    Convert a size like "64G" to a number of bytes.
+    '''
+    if not value:
+        return 0
+    if isinstance(value, int):
+        return value
+    value = str(value).strip().upper()
+    units = {'K': 1, 'M': 2, 'G': 3, 'T': 4}
+    if value[-1] in units:
+        return int(float(value[:-1]) * pow(1024, units[value[-1]]))
+    return int(value)
+
+
+def open_data_cache(cache, cache_dir, conf, readonly=False):
+    '''
+    Open the cache in cache_dir, using the CacheOptions of the configuration.
+    '''
+    cache_opts = conf.get("CacheOptions")
+    if not cache_opts:
+        cache_opts = dict()
+    return cache.open(cache_dir,
+                      sync=cache_opts.get("Sync", True),
+                      metasync=cache_opts.get("MetaSync", True),
+                      writemap=cache_opts.get("WriteMap", False),
+                      readahead=cache_opts.get("ReadAhead", True),
+                      check_integrity=cache_opts.get("CheckIntegrity", True),
+                      compression=cache_opts.get("Compression"),
+                      map_size=parse_size(cache_opts.get("MapSize")),
+                      map_growth=parse_size(cache_opts.get("MapSizeGrowth")),
+                      readonly=readonly)
+
+
 def load_generator_config(wdir):
     conf_fname = os.path.join(wdir, "dep11-config.yml")
     if not os.path.isfile(conf_fname):
@@ -110,7 +296,11 @@ class DEP11Generator:
         pass
 
 
-    def initialize(self, dep11_dir):
+    def initialize(self, dep11_dir, readonly=False):
+        '''
+        Load the configuration and open the cache. With readonly set, nothing
+        is created or changed, which is meant for inspecting the cache.
+        '''
         dep11_dir = os.path.abspath(dep11_dir)
 
         conf = load_generator_config(dep11_dir)
@@ -132,10 +322,17 @@ class DEP11Generator:
         if conf.get("ExportDir"):
             self._export_dir = conf.get("ExportDir")
 
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-        if not os.path.exists(self._export_dir):
-            os.makedirs(self._export_dir)
+        if not readonly:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            if not os.path.exists(self._export_dir):
+                os.makedirs(self._export_dir)
+
+            # keep parsed Packages indices around, so we don't need to parse them again
+            set_packages_index_cache_dir(os.path.join(cache_dir, "packages-index"))
+
+        # remember what we change in the export directory, for publishing
+        self._change_log = ExportChangeLog(self._export_dir, os.path.join(dep11_dir, "export-changes"))
 
         self._suites_data = conf['Suites']
 
@@ -144,8 +341,11 @@ class DEP11Generator:
             self._distro_name = "Debian"
 
         # initialize our on-dik metadata pool
-        self._cache = DataCache(self._get_media_dir())
-        ret = self._cache.open(cache_dir)
+        if readonly:
+            self._cache = DataCache(os.path.join(self._export_dir, "media"))
+        else:
+            self._cache = DataCache(self._get_media_dir())
+        ret = open_data_cache(self._cache, cache_dir, conf, readonly)
 
         os.chdir(dep11_dir)
         return ret
@@ -162,47 +362,6 @@ class DEP11Generator:
         return read_packages_dict_from_file(self._archive_root, suite, component, arch).values()
 
 
-    def make_icon_tar(self, suitename, component, pkglist):
-        '''
-         Generate icons-%(size).tar.gz
-        '''
-        dep11_mediadir = self._get_media_dir()
-        names_seen = set()
-        tar_location = os.path.join(self._export_dir, "data", suitename, component)
-
-        size_tars = dict()
-
-        for pkg in pkglist:
-            pkid = get_pkg_id(pkg['name'], pkg['version'], pkg['arch'])
-
-            gids = self._cache.get_cpt_gids_for_pkg(pkid)
-            if not gids:
-                # no component global-ids == no icons to add to the tarball
-                continue
-
-            for gid in gids:
-                for size in self._icon_sizes:
-                    icon_location_glob = os.path.join (dep11_mediadir, component, gid, "icons", size, "*.png")
-
-                    tar = None
-                    if size not in size_tars:
-                        icon_tar_fname = os.path.join(tar_location, "icons-%s.tar.gz" % (size))
-                        size_tars[size] = tarfile.open(icon_tar_fname+".new", "w:gz")
-                    tar = size_tars[size]
-
-                    for filename in glob.glob(icon_location_glob):
-                        icon_name = os.path.basename(filename)
-                        if size+"/"+icon_name in names_seen:
-                            continue
-                        tar.add(filename, arcname=icon_name)
-                        names_seen.add(size+"/"+icon_name)
-
-        for tar in size_tars.values():
-            tar.close()
-            # FIXME Ugly....
-            safe_move_file(tar.name, tar.name.replace(".new", ""))
-
-
     def process_suite(self, suite_name):
         '''
         Extract new metadata for a given suite.
@@ -220,62 +379,14 @@ class DEP11Generator:
         # when using simple fork as startup method.
         mp.set_start_method('forkserver')
 
+        export_tasks = list()
+        snapshots = list()
         for component in suite['components']:
-            all_cpt_pkgs = list()
+            all_cpt_pkids = list()
+            component_changed = False
             for arch in suite['architectures']:
                 pkglist = self._get_packages_for(suite_name, component, arch)
 
-                # compile a list of packages that we need to look into
-                pkgs_todo = dict()
-                for pkg in pkglist:
-                    pkid = get_pkg_id(pkg['name'], pkg['version'], pkg['arch'])
-
-                    # check if we scanned the package already
-                    if self._cache.package_exists(pkid):
-                        continue
-                    pkgs_todo[pkid] = pkg
-
-                # set up metadata extractor
-                iconf = ContentsListIconFinder(suite_name, component, arch, self._archive_root)
-                mde = MetadataExtractor(suite_name,
-                                component,
-                                self._icon_sizes,
-                                self._cache,
-                                iconf)
-
-                # Multiprocessing can't cope with LMDB open in the cache,
-                # but instead of throwing an error or doing something else
-                # that makes debugging easier, it just silently skips each
-                # multprocessing task. Stupid thing.
-                # (remember to re-open the cache later)
-                self._cache.close()
-
-                # set up multiprocessing
-                with mp.Pool(maxtasksperchild=16) as pool:
-                    def handle_results(message):
-                        log.info(message)
-
-                    def handle_error(e):
-                        traceback.print_exception(type(e), e, e.__traceback__)
-                        log.error(str(e))
-                        pool.terminate()
-                        sys.exit(5)
-
-                    log.info("Processing %i packages in %s/%s/%s" % (len(pkgs_todo), suite_name, component, arch))
-                    for pkid, pkg in pkgs_todo.items():
-                        package_fname = os.path.join (self._archive_root, pkg['filename'])
-                        if not os.path.exists(package_fname):
-                            log.warning('Package not found: %s' % (package_fname))
-                            continue
-                        pool.apply_async(extract_metadata,
-                                    (mde, suite_name, pkg['name'], package_fname, pkg['version'], pkg['arch'], pkid),
-                                    callback=handle_results, error_callback=handle_error)
-                    pool.close()
-                    pool.join()
-
-                # reopen the cache, we need it
-                self._cache.reopen()
-
                 hints_dir = os.path.join(self._export_dir, "hints", suite_name, component)
                 if not os.path.exists(hints_dir):
                     os.makedirs(hints_dir)
@@ -283,38 +394,194 @@ class DEP11Generator:
                 if not os.path.exists(dep11_dir):
                     os.makedirs(dep11_dir)
 
-                # now write data to disk
                 hints_fname = os.path.join(hints_dir, "DEP11Hints_%s.yml.gz" % (arch))
+                validation_fname = os.path.join(hints_dir, "DEP11Validation_%s.json" % (arch))
                 data_fname = os.path.join(dep11_dir, "Components-%s.yml.gz" % (arch))
-
-                hints_f = gzip.open(hints_fname+".new", 'wb')
-                data_f = gzip.open(data_fname+".new", 'wb')
-
                 dep11_header = get_dep11_header(suite_name, component, os.path.join(self._dep11_url, component))
-                data_f.write(bytes(dep11_header, 'utf-8'))
 
+                pkgs_index = dict()
                 for pkg in pkglist:
-                    pkid = get_pkg_id(pkg['name'], pkg['version'], pkg['arch'])
-                    data = self._cache.get_metadata_for_pkg(pkid)
-                    if data:
-                        data_f.write(bytes(data, 'utf-8'))
-                    hint = self._cache.get_hints(pkid)
-                    if hint:
-                        hints_f.write(bytes(hint, 'utf-8'))
+                    pkgs_index[get_pkg_id(pkg.name, pkg.version, pkg.arch)] = pkg
+                pkids = list(pkgs_index.keys())
+                all_cpt_pkids.extend(pkids)
+
+                # if the package index is the same as in our last run, there is nothing to do
+                index_hash = hashlib.sha256(bytes(dep11_header, 'utf-8'))
+                for pkid in sorted(pkids):
+                    index_hash.update(bytes(pkid+"\n", 'utf-8'))
+                index_hash = index_hash.hexdigest()
+                snapshot_key = "%s/%s/%s" % (suite_name, component, arch)
+                last_hash, last_pkids = self._cache.get_index_snapshot(snapshot_key)
+                if index_hash == last_hash and os.path.isfile(data_fname) and os.path.isfile(hints_fname) \
+                        and os.path.isfile(validation_fname):
+                    log.info("Packages in %s/%s/%s have not changed, skipping." % (suite_name, component, arch))
+                    continue
+                component_changed = True
 
-                data_f.close()
-                safe_move_file(data_fname+".new", data_fname)
+                # compile a list of packages that we need to look into
+                pkgs_todo = dict()
+                for pkid, pkg in pkgs_index.items():
+                    # packages from the last run have been processed already
+                    if pkid in last_pkids:
+                        continue
+                    # check if we scanned the package already
+                    if self._cache.package_exists(pkid):
+                        continue
+                    pkgs_todo[pkid] = pkg
 
-                hints_f.close()
-                safe_move_file(hints_fname+".new", hints_fname)
+                if pkgs_todo:
+                    self._extract_packages(suite_name, component, arch, pkgs_todo)
 
-                all_cpt_pkgs.extend(pkglist)
+                export_tasks.append((export_arch_data, (self._cache, dep11_header, pkids, data_fname, hints_fname, validation_fname)))
 
-            # create icon tarball
-            self.make_icon_tar(suite_name, component, all_cpt_pkgs)
+                # remember which packages we have seen, excluding the ones we failed to process.
+                # The index is only skipped next time if all of its packages were processed,
+                # so the failed ones are retried.
+                done_pkids = [pkid for pkid in pkids if pkid not in pkgs_todo or self._cache.package_exists(pkid)]
+                if len(done_pkids) != len(pkids):
+                    index_hash = ""
+                snapshots.append((snapshot_key, index_hash, done_pkids))
+
+            # create icon tarballs
+            if component_changed:
+                export_tasks.extend(self._get_icon_tar_tasks(suite_name, component, all_cpt_pkids))
 
             log.info("Completed metadata extraction for suite %s/%s" % (suite_name, component))
 
+        if export_tasks:
+            self._export_data(export_tasks)
+
+        # only remember the package indices once their data was exported
+        for snapshot_key, index_hash, done_pkids in snapshots:
+            self._cache.set_index_snapshot(snapshot_key, index_hash, done_pkids)
+        self._cache.sync()
+
+
+    def _get_icon_tar_tasks(self, suite_name, component, pkids):
+        '''
+        Find the icon tarballs of a component which need to be
+        regenerated, because the icons they should contain have changed.
+        '''
+        tar_location = os.path.join(self._export_dir, "data", suite_name, component)
+
+        gids = list()
+        for pkid in pkids:
+            cpt_gids = self._cache.get_cpt_gids_for_pkg(pkid)
+            if cpt_gids:
+                gids.extend(cpt_gids)
+        manifest = self._cache.get_icon_manifest(component, gids)
+
+        tasks = list()
+        for size in self._icon_sizes:
+            icons = dict()
+            for gid in gids:
+                for icon_size, icon_name, filename in manifest[gid]:
+                    if icon_size != size or icon_name in icons:
+                        continue
+                    icons[icon_name] = filename
+            icons = sorted(icons.items())
+
+            tar_hash = hashlib.sha256()
+            for icon_name, filename in icons:
+                tar_hash.update(bytes("%s\t%s\n" % (icon_name, filename), 'utf-8'))
+            tar_hash = tar_hash.hexdigest()
+
+            tar_fname = os.path.join(tar_location, "icons-%s.tar.gz" % (size))
+            if tar_hash == self._cache.get_export_hash(tar_fname) and os.path.isfile(tar_fname):
+                log.info("Icons in %s are unchanged." % (tar_fname))
+                continue
+            tasks.append((make_icon_tar, (tar_fname, tar_hash, icons)))
+        return tasks
+
+
+    def _export_data(self, export_tasks):
+        '''
+        Write the data files and icon tarballs of all components and
+        architectures in parallel.
+        '''
+        export_hashes = list()
+        errors = list()
+
+        # the workers open their own read-only connection to the cache
+        self._cache.close()
+
+        with mp.Pool() as pool:
+            def handle_results(result):
+                msgtxt, written = result
+                log.info(msgtxt)
+                export_hashes.extend(written)
+
+            def handle_error(e):
+                # this runs in the pool's result thread, the error is raised in ours
+                traceback.print_exception(type(e), e, e.__traceback__)
+                errors.append(e)
+
+            log.info("Exporting data (%i tasks)" % (len(export_tasks)))
+            for func, args in export_tasks:
+                pool.apply_async(func, args, callback=handle_results, error_callback=handle_error)
+            pool.close()
+            pool.join()
+
+        self._cache.reopen()
+        for fname, data_hash in export_hashes:
+            self._cache.set_export_hash(fname, data_hash)
+            self._change_log.add_changed(fname)
+
+        # don't let the index snapshots be stored, so the failed files are exported next time
+        if errors:
+            self._cache.sync()
+            raise Exception("Failed to export data: %s" % (str(errors[0])))
+
+
+    def _extract_packages(self, suite_name, component, arch, pkgs_todo):
+        '''
+        Extract metadata from the given packages of suite_name/component/arch
+        and store it in the cache.
+        '''
+        # set up metadata extractor
+        iconf = ContentsListIconFinder(suite_name, component, arch, self._archive_root)
+        mde = MetadataExtractor(suite_name,
+                        component,
+                        self._icon_sizes,
+                        self._cache,
+                        iconf)
+        mde.change_log = self._change_log
+
+        # Multiprocessing can't cope with LMDB open in the cache,
+        # but instead of throwing an error or doing something else
+        # that makes debugging easier, it just silently skips each
+        # multprocessing task. Stupid thing.
+        # (remember to re-open the cache later)
+        self._cache.close()
+
+        # set up multiprocessing
+        with mp.Pool(maxtasksperchild=16) as pool:
+            def handle_results(message):
+                log.info(message)
+
+            def handle_error(e):
+                traceback.print_exception(type(e), e, e.__traceback__)
+                log.error(str(e))
+                pool.terminate()
+                sys.exit(5)
+
+            log.info("Processing %i packages in %s/%s/%s" % (len(pkgs_todo), suite_name, component, arch))
+            for pkid, pkg in pkgs_todo.items():
+                package_fname = os.path.join (self._archive_root, pkg.filename)
+                if not os.path.exists(package_fname):
+                    log.warning('Package not found: %s' % (package_fname))
+                    continue
+                pool.apply_async(extract_metadata,
+                            (mde, suite_name, pkg.name, package_fname, pkg.version, pkg.arch, pkid),
+                            callback=handle_results, error_callback=handle_error)
+            pool.close()
+            pool.join()
+
+        # reopen the cache, we need it
+        self._cache.reopen()
+        # all extractor processes are done, ensure their data hits the disk
+        self._cache.sync()
+
 
     def expire_cache(self):
         pkgids = set()
@@ -324,7 +591,7 @@ class DEP11Generator:
                 for arch in suite['architectures']:
                     pkglist = self._get_packages_for(suite_name, component, arch)
                     for pkg in pkglist:
-                        pkid = get_pkg_id(pkg['name'], pkg['version'], pkg['arch'])
+                        pkid = get_pkg_id(pkg.name, pkg.version, pkg.arch)
                         pkgids.add(pkid)
 
         # clean cache
@@ -332,8 +599,93 @@ class DEP11Generator:
         for pkid in oldpkgs:
             pkid = str(pkid, 'utf-8')
             self._cache.remove_package(pkid)
+        # the snapshots may list removed packages as processed, which would
+        # prevent them from being processed again if they show up again
+        if oldpkgs:
+            self._cache.remove_index_snapshots()
         # ensure we don't leave cruft
-        self._cache.remove_orphaned_components()
+        for media_dir in self._cache.remove_orphaned_components():
+            self._change_log.add_removed(media_dir)
+        self._cache.sync()
+
+
+    def show_cache_stats(self, as_json=False):
+        '''
+        Print information about the contents and size of the cache.
+        '''
+        stats = self._cache.get_stats()
+
+        # how many packages of the archive are in the cache already, and
+        # will not be processed again
+        index_stats = dict()
+        for suite_name, suite in self._suites_data.items():
+            for component in suite['components']:
+                for arch in suite['architectures']:
+                    try:
+                        pkglist = self._get_packages_for(suite_name, component, arch)
+                    except Exception as e:
+                        log.warning(str(e))
+                        continue
+                    pkids = [get_pkg_id(pkg.name, pkg.version, pkg.arch) for pkg in pkglist]
+                    index_stats["%s/%s/%s" % (suite_name, component, arch)] = \
+                            {'packages': len(pkids), 'cached': self._cache.count_existing_packages(pkids)}
+        stats['indices'] = index_stats
+
+        if as_json:
+            print(json.dumps(stats, indent=2, sort_keys=True))
+            return
+
+        def size_str(size):
+            for unit in ["B", "KiB", "MiB", "GiB"]:
+                if size < 1024:
+                    return "%.1f %s" % (size, unit)
+                size = size / 1024
+            return "%.1f TiB" % (size)
+
+        print("Databases:")
+        print("  %-14s %10s %12s %12s %8s %8s %8s %6s" % ("Name", "Entries", "Keys", "Values",
+                                                         "Branch", "Leaf", "Overflow", "Depth"))
+        for name, dbs in sorted(stats['databases'].items()):
+            print("  %-14s %10i %12s %12s %8i %8i %8i %6i" % (name, dbs['entries'], size_str(dbs['key_bytes']),
+                                                             size_str(dbs['value_bytes']), dbs['branch_pages'],
+                                                             dbs['leaf_pages'], dbs['overflow_pages'], dbs['depth']))
+
+        pkgs = stats['packages']
+        total = pkgs['total']
+        print("Packages: %i" % (total))
+        for key, desc in [('with_components', "with components"), ('seen', "with hints only"), ('ignored', "ignored")]:
+            perc = 100/total*pkgs[key] if total > 0 else 0
+            print("  %-16s %10i (%.1f%%)" % (desc+":", pkgs[key], perc))
+
+        print("Package indices:")
+        total = 0
+        cached = 0
+        for name, istats in sorted(index_stats.items()):
+            perc = 100/istats['packages']*istats['cached'] if istats['packages'] > 0 else 0
+            print("  %-30s %8i packages, %8i cached (%.1f%%)" % (name, istats['packages'], istats['cached'], perc))
+            total += istats['packages']
+            cached += istats['cached']
+        perc = 100/total*cached if total > 0 else 0
+        print("  Cache hit rate: %.1f%% of %i packages" % (perc, total))
+
+        mstats = stats['map']
+        print("Map: %s of %s used (%.2f%%), %i pages of %s, file size %s" % (size_str(mstats['used_bytes']),
+                                        size_str(mstats['map_size']), mstats['fill']*100, mstats['used_pages'],
+                                        size_str(mstats['page_size']), size_str(mstats['file_bytes'])))
+        print("Orphaned components: %i, with %s of media" % (stats['orphaned']['components'],
+                                                                 size_str(stats['orphaned']['media_bytes'])))
+
+
+    def compact_cache(self):
+        '''
+        Remove free space from the cache database.
+        '''
+        sizes = self._cache.compact()
+        if not sizes:
+            return False
+        old_size, new_size = sizes
+        log.info("Compacted cache from %i MiB to %i MiB." % (old_size / pow(1024, 2), new_size / pow(1024, 2)))
+        return True
 
 
     def remove_processed(self, suite_name):
@@ -352,8 +704,8 @@ class DEP11Generator:
                 pkglist = self._get_packages_for(suite_name, component, arch)
 
                 for pkg in pkglist:
-                    package_fname = os.path.join (self._archive_root, pkg['filename'])
-                    pkid = get_pkg_id(pkg['name'], pkg['version'], pkg['arch'])
+                    package_fname = os.path.join (self._archive_root, pkg.filename)
+                    pkid = get_pkg_id(pkg.name, pkg.version, pkg.arch)
 
                     # we ignore packages without any interesting metadata here
                     if self._cache.is_ignored(pkid):
@@ -361,8 +713,22 @@ class DEP11Generator:
 
                     self._cache.remove_package(pkid)
 
+        # the packages need to be processed again in the next run. Other suites
+        # may ship the same packages, so their snapshots are not valid anymore either.
+        self._cache.remove_index_snapshots()
+
         # drop all components which don't have packages
-        self._cache.remove_orphaned_components()
+        for media_dir in self._cache.remove_orphaned_components():
+            self._change_log.add_removed(media_dir)
+        self._cache.sync()
+
+
+    def publish(self, public_dir):
+        '''
+        Copy everything that changed in the export directory since
+        the last run to public_dir.
+        '''
+        return publish_export(self._change_log, public_dir)
 
 
 class HTMLGenerator:
@@ -401,14 +767,92 @@ class HTMLGenerator:
         if not os.path.exists(self._export_dir):
             os.makedirs(self._export_dir)
 
+        cache_dir = os.path.join(dep11_dir, "cache")
+        if conf.get("CacheDir"):
+            cache_dir = conf.get("CacheDir")
+        set_packages_index_cache_dir(os.path.join(cache_dir, "packages-index"))
+        # hashes of the data each HTML page was rendered from
+        self._page_manifest_fname = os.path.join(cache_dir, "html-pages.json")
+        self._page_hashes = dict()
+        self._old_page_hashes = dict()
+        self._templates_hash = None
+        # compiled templates, shared by all rendering processes
+        self._bytecode_cache_dir = os.path.join(cache_dir, "templates-bytecode")
+        self._render_pool = None
+        self._render_queue = list()
+        self._render_errors = list()
+        # highlighted metadata which is not in the cache yet
+        self._highlight_version = "%s-%s" % (_HIGHLIGHT_FORMAT_VERSION, pygments.__version__ if pygments else "none")
+        self._new_highlights = dict()
+
         self._suites_data = conf['Suites']
 
         self._html_export_dir = os.path.join(self._export_dir, "html")
+        self._change_log = ExportChangeLog(self._export_dir, os.path.join(dep11_dir, "export-changes"))
 
         self._dep11_url = conf.get("MediaBaseUrl")
 
+        # the pages are generated from the data in the cache
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._cache = DataCache(os.path.join(self._export_dir, "media"))
+        ret = open_data_cache(self._cache, cache_dir, conf)
+
         os.chdir(dep11_dir)
-        return True
+        return ret
+
+
+    def _get_templates_hash(self):
+        if self._templates_hash:
+            return self._templates_hash
+        templates_hash = hashlib.sha256()
+        for fname in sorted(os.listdir(self._template_dir)):
+            fname = os.path.join(self._template_dir, fname)
+            if os.path.isfile(fname):
+                with open(fname, 'rb') as f:
+                    templates_hash.update(f.read())
+        # the pages also depend on the globals passed to the templates in
+        # _flush_render_queue(), except for the time they were rendered at
+        templates_hash.update(bytes(json.dumps([self._html_url, self._distro_name]), 'utf-8'))
+        self._templates_hash = templates_hash.hexdigest()
+        return self._templates_hash
+
+
+    def _load_page_manifest(self):
+        self._page_hashes = dict()
+        self._old_page_hashes = dict()
+        if not os.path.isfile(self._page_manifest_fname):
+            return
+        try:
+            with open(self._page_manifest_fname, 'r') as f:
+                self._old_page_hashes = json.load(f)
+        except Exception as e:
+            log.warning("Could not read HTML page manifest, rendering all pages: %s" % (str(e)))
+
+
+    def _save_page_manifest(self):
+        manifest_dir = os.path.dirname(self._page_manifest_fname)
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        with open(self._page_manifest_fname+".new", 'w') as f:
+            json.dump(self._page_hashes, f)
+        os.replace(self._page_manifest_fname+".new", self._page_manifest_fname)
+
+
+    def _remove_stale_pages(self):
+        '''
+        Remove pages which were rendered in a previous run, but
+        not in this one, e.g. because their package is gone.
+        '''
+        for page in self._old_page_hashes.keys():
+            if page in self._page_hashes:
+                continue
+            out_path = os.path.join(self._html_export_dir, page)
+            log.debug("Remove: %s" % (page))
+            for fname in [out_path, out_path+".gz"]:
+                if os.path.isfile(fname):
+                    os.remove(fname)
+                    self._change_log.add_removed(fname)
 
 
     def render_template(self, name, out_dir, out_name = None, *args, **kwargs):
@@ -416,19 +860,97 @@ class HTMLGenerator:
             out_path = os.path.join(out_dir, name)
         else:
             out_path = os.path.join(out_dir, out_name)
-        # create subdirectories if necessary
-        out_dir = os.path.dirname(os.path.realpath(out_path))
+
+        # don't render the page again if the data it shows has not changed
+        page_hash = hashlib.sha256(bytes(self._get_templates_hash() + name, 'utf-8'))
+        page_hash.update(bytes(json.dumps([args, kwargs], sort_keys=True, default=str), 'utf-8'))
+        page_hash = page_hash.hexdigest()
+        page = os.path.relpath(out_path, self._html_export_dir)
+        self._page_hashes[page] = page_hash
+        if self._old_page_hashes.get(page) == page_hash and os.path.isfile(out_path):
+            return
+
+        log.debug("Render: %s" % (out_path.replace(self._html_export_dir, "")))
+        self._render_queue.append((name, out_path, args, kwargs))
+        self._change_log.add_changed(out_path)
+        self._change_log.add_changed(out_path+".gz")
+
+
+    def write_json(self, out_dir, out_name, data):
+        out_path = os.path.join(out_dir, out_name)
+        content = bytes(json.dumps(data, separators=(',', ':')), 'utf-8')
+
+        page_hash = hashlib.sha256(content).hexdigest()
+        page = os.path.relpath(out_path, self._html_export_dir)
+        self._page_hashes[page] = page_hash
+        if self._old_page_hashes.get(page) == page_hash and os.path.isfile(out_path):
+            return
+
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
+        write_page(out_path, content)
+        self._change_log.add_changed(out_path)
+        self._change_log.add_changed(out_path+".gz")
 
-        j2_env = Environment(loader=FileSystemLoader(self._template_dir))
 
-        template = j2_env.get_template(name)
-        content = template.render(root_url=self._html_url, distro=self._distro_name,
-                                    time=time.strftime("%Y-%m-%d %H:%M:%S %Z"), *args, **kwargs)
-        log.debug("Render: %s" % (out_path.replace(self._html_export_dir, "")))
-        with open(out_path, 'wb') as f:
-            f.write(bytes(content, 'utf-8'))
+    def _render_index_pages(self, name, out_dir, package_summaries, get_details, **kwargs):
+        '''
+        Render an index of packages by maintainer, split into one page per first letter
+        of the maintainer names, with a search index for filtering all packages.
+        '''
+        pages = dict()
+        search_index = list()
+        for maintainer in sorted(package_summaries.keys(), key=lambda m: m.lower()):
+            letter = get_index_letter(maintainer)
+            if not pages.get(letter):
+                pages[letter] = dict()
+            pages[letter][maintainer] = package_summaries[maintainer]
+            for pkg_name, summary in package_summaries[maintainer].items():
+                search_index.append([pkg_name, maintainer, get_details(summary)])
+        letters = sorted(pages.keys())
+
+        self.render_template(name, out_dir, "index.html", letters=letters, letter=None,
+                            package_summaries=dict(), **kwargs)
+        for letter, summaries in pages.items():
+            self.render_template(name, out_dir, "index-%s.html" % (letter), letters=letters, letter=letter,
+                            package_summaries=summaries, **kwargs)
+        self.write_json(out_dir, "search.json", search_index)
+
+
+    def _flush_render_queue(self):
+        '''
+        Hand the pages queued by render_template() over to the rendering processes.
+        '''
+        template_globals = {'root_url': self._html_url, 'distro': self._distro_name,
+                            'time': time.strftime("%Y-%m-%d %H:%M:%S %Z")}
+
+        def handle_results(message):
+            log.debug(message)
+
+        def handle_error(e):
+            # this runs in the pool's result thread, the error is raised in ours
+            traceback.print_exception(type(e), e, e.__traceback__)
+            self._render_errors.append(e)
+
+        self._check_render_errors()
+        for i in range(0, len(self._render_queue), _RENDER_BATCH_SIZE):
+            pages = self._render_queue[i:i+_RENDER_BATCH_SIZE]
+            self._render_pool.apply_async(render_pages,
+                        (self._template_dir, self._bytecode_cache_dir, template_globals, pages),
+                        callback=handle_results, error_callback=handle_error)
+        self._render_queue = list()
+
+
+    def _check_render_errors(self):
+        '''
+        Stop if rendering any page failed. The page manifest is not saved then,
+        so pages which were not written are rendered again next time.
+        '''
+        if not self._render_errors:
+            return
+        self._render_pool.terminate()
+        self._render_pool = None
+        raise Exception("Failed to render HTML pages: %s" % (str(self._render_errors[0])))
 
 
     def _highlight_yaml(self, yml_data):
@@ -439,6 +961,25 @@ class HTMLGenerator:
         return pygments.highlight(yml_data, YamlLexer(), HtmlFormatter())
 
 
+    def _get_highlighted_metadata(self, gid):
+        '''
+        Get the syntax-highlighted metadata of a component. Its global-id covers
+        all of its metadata, so each component only needs to be highlighted once.
+        '''
+        mdata_html = self._cache.get_highlighted_metadata(gid, self._highlight_version)
+        if mdata_html == None:
+            mdata_html = self._highlight_yaml(self._cache.get_metadata(gid))
+            self._new_highlights[gid] = mdata_html
+        return mdata_html
+
+
+    def _store_highlighted_metadata(self):
+        if not self._new_highlights:
+            return
+        self._cache.set_highlighted_metadata(self._new_highlights, self._highlight_version)
+        self._new_highlights = dict()
+
+
     def _expand_hint(self, hint_data):
         tag_name = hint_data['tag']
         tag = get_hint_tag_info(tag_name)
@@ -469,10 +1010,15 @@ class HTMLGenerator:
         media_dir = os.path.join(self._export_dir, "media")
         noimage_url = os.path.join(self._html_url, "static", "img", "no-image.png")
 
+        self._load_page_manifest()
+
+        # pages are rendered in parallel, while we collect the data of the next ones
+        self._render_pool = mp.Pool()
+        self._render_errors = list()
+
         # Render archive suites index page
-        self.render_template("suites_index.html", export_dir, "index.html", suites=self._suites_data.keys())
+        self.render_template("suites_index.html", export_dir, "index.html", suites=list(self._suites_data.keys()))
 
-        # TODO: Remove old HTML files
         for suite_name in self._suites_data:
             suite = self._suites_data[suite_name]
             export_dir = os.path.join(self._export_dir, "html", suite_name)
@@ -496,23 +1042,25 @@ class HTMLGenerator:
 
                 hint_pages = dict()
                 cpt_pages = dict()
+                # we fold multiple architectures with the same issues or components into one view,
+                # these map the content of an entry to the entry on its package's page
+                hint_entries = dict()
+                cpt_entries = dict()
 
                 for arch in suite['architectures']:
-                    h_fname = os.path.join(dep11_hintsdir, suite_name, component, "DEP11Hints_%s.yml.gz" % (arch))
-                    hints_data = None
-                    if os.path.isfile(h_fname):
-                        f = gzip.open(h_fname, 'r')
-                        hints_data = yaml.safe_load_all(f.read())
-                        f.close()
-
-                    d_fname = os.path.join(dep11_minfodir, suite_name, component, "Components-%s.yml.gz" % (arch))
-                    dep11_data = None
-                    if os.path.isfile(d_fname):
-                        f = gzip.open(d_fname, 'r')
-                        dep11_data = yaml.safe_load_all(f.read())
-                        f.close()
-
+                    validation_fname = os.path.join(dep11_hintsdir, suite_name, component, "DEP11Validation_%s.json" % (arch))
                     pkg_index = read_packages_dict_from_file(self._archive_root, suite_name, component, arch)
+                    pkids = [get_pkg_id(pkg.name, pkg.version, pkg.arch) for pkg in pkg_index.values()]
+                    records = self._cache.get_package_records(pkids)
+
+                    hints_data = list()
+                    dep11_data = list()
+                    for pkid, hints, cpt_infos in records:
+                        if hints:
+                            hints_data.extend(yaml.safe_load_all(hints))
+                        for gid, info in cpt_infos.items():
+                            if info:
+                                dep11_data.append((gid, info))
 
                     if hints_data:
                         for hdata in hints_data:
@@ -523,33 +1071,13 @@ class HTMLGenerator:
                             pkg = pkg_index.get(pkg_name)
                             maintainer = None
                             if pkg:
-                                maintainer = pkg['maintainer']
+                                maintainer = pkg.maintainer
                             if not maintainer:
                                 maintainer = "Unknown"
                             if not issue_summaries.get(maintainer):
                                 issue_summaries[maintainer] = dict()
 
-                            hints_raw = hdata.get('Hints', list())
-
-                            # expand all hints to show long descriptions
-                            errors = list()
-                            warnings = list()
-                            infos = list()
-
-                            for hint in hints_raw:
-                                ehint = self._expand_hint(hint)
-                                severity = ehint['severity']
-                                if severity == "info":
-                                    infos.append(ehint)
-                                elif severity == "warning":
-                                    warnings.append(ehint)
-                                else:
-                                    errors.append(ehint)
-
-                            if not hint_pages.get(pkg_name):
-                                hint_pages[pkg_name] = list()
-
-                            # we fold multiple architectures with the same issues into one view
+                            # identify the entry without its architecture
                             pkid_noarch = pkg_id
                             if "/" in pkg_id:
                                 pkid_noarch = pkg_id[:pkg_id.rfind("/")]
@@ -560,13 +1088,33 @@ class HTMLGenerator:
                             else:
                                 pcid = pkid_noarch
 
-                            page_data = {'identifier': pcid, 'errors': errors, 'warnings': warnings, 'infos': infos, 'archs': [arch]}
-                            try:
-                                l = hint_pages[pkg_name]
-                                index = next(i for i, v in enumerate(l) if equal_dicts(v, page_data, ['archs']))
-                                hint_pages[pkg_name][index]['archs'].append(arch)
-                            except StopIteration:
+                            hints_raw = hdata.get('Hints', list())
+                            entry_key = (pkg_name, pcid, json.dumps(hints_raw, sort_keys=True, default=str))
+                            entry = hint_entries.get(entry_key)
+                            if entry:
+                                entry['archs'].append(arch)
+                            else:
+                                # expand all hints to show long descriptions
+                                errors = list()
+                                warnings = list()
+                                infos = list()
+
+                                for hint in hints_raw:
+                                    ehint = self._expand_hint(hint)
+                                    severity = ehint['severity']
+                                    if severity == "info":
+                                        infos.append(ehint)
+                                    elif severity == "warning":
+                                        warnings.append(ehint)
+                                    else:
+                                        errors.append(ehint)
+
+                                if not hint_pages.get(pkg_name):
+                                    hint_pages[pkg_name] = list()
+
+                                page_data = {'identifier': pcid, 'errors': errors, 'warnings': warnings, 'infos': infos, 'archs': [arch]}
                                 hint_pages[pkg_name].append(page_data)
+                                hint_entries[entry_key] = page_data
 
                                 # add info to global issue count
                                 error_count += len(errors)
@@ -578,66 +1126,48 @@ class HTMLGenerator:
                                     issue_summaries[maintainer][pkg_name] = {'error_count': len(errors), 'warning_count': len(warnings), 'info_count': len(infos)}
 
                     if dep11_data:
-                        for mdata in dep11_data:
-                            pkg_name = mdata.get('Package')
-                            if not pkg_name:
-                                # we probably hit the header
-                                continue
+                        for cptgid, cinfo in dep11_data:
+                            pkg_name = cinfo['package']
                             pkg = pkg_index.get(pkg_name)
                             maintainer = None
                             if pkg:
-                                maintainer = pkg['maintainer']
+                                maintainer = pkg.maintainer
                             if not maintainer:
                                 maintainer = "Unknown"
                             if not mdata_summaries.get(maintainer):
                                 mdata_summaries[maintainer] = dict()
 
+                            cid = cinfo['cid']
 
-                            # ugly hack to have the screenshot entries linked
-                            #if mdata.get('Screenshots'):
-                            #    sshot_baseurl = os.path.join(self._dep11_url, component)
-                            #    for i in range(len(mdata['Screenshots'])):
-                            #        url = mdata['Screenshots'][i]['source-image']['url']
-                            #        url = "<a href=\"%s\">%s</a>" % (os.path.join(sshot_baseurl, url), url)
-                            #        mdata['Screenshots'][i]['source-image']['url'] = Markup(url)
-                            #        thumbnails = mdata['Screenshots'][i]['thumbnails']
-                            #        for j in range(len(thumbnails)):
-                            #            url = thumbnails[j]['url']
-                            #            url = "<a href=\"%s\">%s</a>" % (os.path.join(sshot_baseurl, url), url)
-                            #            thumbnails[j]['url'] = Markup(url)
-                            #        mdata['Screenshots'][i]['thumbnails'] = thumbnails
-
-
-                            mdata_yml = dict_to_dep11_yaml(mdata)
-                            mdata_yml = self._highlight_yaml(mdata_yml)
-                            cid = mdata.get('ID')
-
-                            # try to find an icon for this component (if it's a GUI app)
-                            icon_url = None
-                            if mdata['Type'] == 'desktop-app' or mdata['Type'] == "web-app":
-                                icon_name = mdata['Icon'].get("cached")
-                                cptgid = build_cpt_global_id(cid, mdata.get('X-Source-Checksum'))
-                                if icon_name and cptgid:
-                                    icon_fname = os.path.join(component, cptgid, "icons", "64x64", icon_name)
-                                    if os.path.isfile(os.path.join(media_dir, icon_fname)):
-                                        icon_url = os.path.join(self._dep11_url, icon_fname)
+                            # the global-id covers all of the component's metadata
+                            entry = cpt_entries.get((pkg_name, cptgid))
+                            if entry:
+                                entry['archs'].append(arch)
+                            else:
+                                # the cache has the metadata exactly as it was exported
+                                mdata_yml = self._get_highlighted_metadata(cptgid)
+
+                                # try to find an icon for this component (if it's a GUI app)
+                                icon_url = None
+                                if cinfo['type'] == 'desktop-app' or cinfo['type'] == "web-app":
+                                    icon_name = cinfo['icon']
+                                    if icon_name:
+                                        icon_fname = os.path.join(component, cptgid, "icons", "64x64", icon_name)
+                                        if os.path.isfile(os.path.join(media_dir, icon_fname)):
+                                            icon_url = os.path.join(self._dep11_url, icon_fname)
+                                        else:
+                                            icon_url = noimage_url
                                     else:
                                         icon_url = noimage_url
                                 else:
-                                    icon_url = noimage_url
-                            else:
-                                icon_url = os.path.join(self._html_url, "static", "img", "cpt-nogui.png")
+                                    icon_url = os.path.join(self._html_url, "static", "img", "cpt-nogui.png")
 
-                            if not cpt_pages.get(pkg_name):
-                                cpt_pages[pkg_name] = list()
+                                if not cpt_pages.get(pkg_name):
+                                    cpt_pages[pkg_name] = list()
 
-                            page_data = {'cid': cid, 'mdata': mdata_yml, 'icon_url': icon_url, 'archs': [arch]}
-                            try:
-                                l = cpt_pages[pkg_name]
-                                index = next(i for i, v in enumerate(l) if equal_dicts(v, page_data, ['archs']))
-                                cpt_pages[pkg_name][index]['archs'].append(arch)
-                            except StopIteration:
+                                page_data = {'cid': cid, 'mdata': mdata_yml, 'icon_url': icon_url, 'archs': [arch]}
                                 cpt_pages[pkg_name].append(page_data)
+                                cpt_entries[(pkg_name, cptgid)] = page_data
 
                                 # increase valid metainfo count
                                 metainfo_count += 1
@@ -671,25 +1201,25 @@ class HTMLGenerator:
                     self.render_template("metainfo_page.html", export_dir_metainfo, "%s.html" % (pkg_name),
                             package_name=pkg_name, cpts=cptlist, suite=suite_name, section=component)
 
-                # Now render our issue index page
-                self.render_template("issues_index.html", export_dir_issues, "index.html",
-                            package_summaries=issue_summaries, suite=suite_name, section=component)
+                # Now render our issue index pages
+                self._render_index_pages("issues_index.html", export_dir_issues, issue_summaries,
+                            lambda summary: "", suite=suite_name, section=component)
 
-                # ... and the metainfo index page
-                self.render_template("metainfo_index.html", export_dir_metainfo, "index.html",
-                            package_summaries=mdata_summaries, suite=suite_name, section=component)
+                # ... and the metainfo index pages
+                self._render_index_pages("metainfo_index.html", export_dir_metainfo, mdata_summaries,
+                            lambda summary: ", ".join(summary['cids']), suite=suite_name, section=component)
 
 
+                # the data was validated when it was exported
                 validate_result = "Validation was not performed."
-                if dep11_data:
-                    # do format validation
-                    validator = DEP11Validator()
-                    ret = validator.validate_file(d_fname)
-                    if ret:
+                if dep11_data and os.path.isfile(validation_fname):
+                    with open(validation_fname, 'r') as f:
+                        validation = json.load(f)
+                    if validation['valid']:
                         validate_result = "No errors found."
                     else:
                         validate_result = ""
-                        for issue in validator.issue_list:
+                        for issue in validation['issues']:
                             validate_result += issue.replace("FATAL", "<strong>FATAL</strong>")+"<br/>\n"
 
                 # sum up counts for suite statistics
@@ -711,6 +1241,8 @@ class HTMLGenerator:
                             error_percentage=error_perc, warning_percentage=warning_perc, info_percentage=info_perc,
                             metainfo_count=metainfo_count, error_count=error_count, warning_count=warning_count,
                             info_count=info_count, validate_result=validate_result)
+                self._flush_render_queue()
+                self._store_highlighted_metadata()
 
 
             # calculate statistics for this suite
@@ -727,10 +1259,34 @@ class HTMLGenerator:
                             metainfo_count=suite_metainfo_count, error_count=suite_error_count, warning_count=suite_warning_count,
                             info_count=suite_info_count)
 
-        # Copy the static files
+        # wait for all pages to be written
+        self._flush_render_queue()
+        self._render_pool.close()
+        self._render_pool.join()
+        self._check_render_errors()
+        self._render_pool = None
+        self._cache.sync()
+
+        # Copy the static files, if they have changed
+        static_dir = os.path.join(self._template_dir, "static")
         target_static_dir = os.path.join(self._export_dir, "html", "static")
-        shutil.rmtree(target_static_dir, ignore_errors=True)
-        shutil.copytree(os.path.join(self._template_dir, "static"), target_static_dir)
+        static_hash = hashlib.sha256()
+        for root, dirs, files in os.walk(static_dir):
+            dirs.sort()
+            for fname in sorted(files):
+                fname = os.path.join(root, fname)
+                static_hash.update(bytes(os.path.relpath(fname, static_dir), 'utf-8'))
+                with open(fname, 'rb') as f:
+                    static_hash.update(f.read())
+        static_hash = static_hash.hexdigest()
+        self._page_hashes["static"] = static_hash
+        if self._old_page_hashes.get("static") != static_hash or not os.path.isdir(target_static_dir):
+            shutil.rmtree(target_static_dir, ignore_errors=True)
+            shutil.copytree(static_dir, target_static_dir)
+            self._change_log.add_changed(target_static_dir)
+
+        self._remove_stale_pages()
+        self._save_page_manifest()
 
 
 def main():
@@ -741,12 +1297,16 @@ def main():
     parser = ArgumentParser(description="Generate DEP-11 metadata from Debian packages.")
     parser.add_argument('subcommand', help="The command that should be executed.")
     parser.add_argument('parameters', nargs='*', help="Parameters for the subcommand.")
+    parser.add_argument('--json', action='store_true', dest='json', help="Print machine-readable output, where supported.")
 
     parser.usage = "\n"
     parser.usage += " process [CONFDIR] [SUITE] - Process packages and extract metadata.\n"
     parser.usage += " cleanup [CONFDIR]         - Remove unused data from the cache and expire media.\n"
     parser.usage += " update-html [CONFDIR]     - Re-generate the metadata and issue HTML pages.\n"
     parser.usage += " removed-processed [CONFDIR] [SUITE] - Remove information about processed or failed components.\n"
+    parser.usage += " cache-stats [CONFDIR]     - Show statistics about the cache contents and size.\n"
+    parser.usage += " compact-cache [CONFDIR]   - Remove free space from the cache database.\n"
+    parser.usage += " publish [CONFDIR] [PUBLICDIR] - Copy data which changed since the last run to PUBLICDIR.\n"
 
     args = parser.parse_args()
     command = args.subcommand
@@ -805,5 +1365,42 @@ def main():
             sys.exit(2)
 
         gen.remove_processed(params[1])
+
+    elif command == "cache-stats":
+        if len(params) != 1:
+            print("Invalid number of arguments: You need to specify a DEP-11 data dir.")
+            sys.exit(1)
+        gen = DEP11Generator()
+        ret = gen.initialize(params[0], readonly=True)
+        if not ret:
+            print("Initialization failed, can not continue.")
+            sys.exit(2)
+
+        gen.show_cache_stats(args.json)
+
+    elif command == "compact-cache":
+        if len(params) != 1:
+            print("Invalid number of arguments: You need to specify a DEP-11 data dir.")
+            sys.exit(1)
+        gen = DEP11Generator()
+        ret = gen.initialize(params[0])
+        if not ret:
+            print("Initialization failed, can not continue.")
+            sys.exit(2)
+
+        if not gen.compact_cache():
+            sys.exit(5)
+
+    elif command == "publish":
+        if len(params) != 2:
+            print("Invalid number of arguments: You need to specify a DEP-11 data dir and a public directory.")
+            sys.exit(1)
+        gen = DEP11Generator()
+        ret = gen.initialize(params[0])
+        if not ret:
+            print("Initialization failed, can not continue.")
+            sys.exit(2)
+
+        gen.publish(params[1])
     else:
         print("Run with --help for a list of available command-line options!")
@@ -16,10 +16,9 @@
 # License along with this program.
 
 import os
-import gzip
 import re
 from dep11.component import IconSize
-from dep11.utils import read_packages_dict_from_file
+from dep11.utils import read_packages_dict_from_file, find_index_file, open_index_file
 
 
 class AbstractIconFinder:
@@ -69,39 +68,38 @@ class ContentsListIconFinder(AbstractIconFinder):
 
         # FIXME: On Ubuntu, also include the universe component to find more icons, since
         # they have split the default iconsets for KDE/GNOME apps between main/universe.
-        universe_cfname = os.path.join(self._mirror_dir, "dists", self._suite_name, "universe", "Contents-%s.gz" % (arch_name))
-        if os.path.isfile(universe_cfname):
+        suite_dir = os.path.join(self._mirror_dir, "dists", self._suite_name)
+        if find_index_file(suite_dir, "universe/Contents-%s" % (arch_name)):
             self._load_contents_data(arch_name, "universe")
 
     def _load_contents_data(self, arch_name, component):
-        contents_basename = "Contents-%s.gz" % (arch_name)
-        contents_fname = os.path.join(self._mirror_dir, "dists", self._suite_name, component, contents_basename)
+        suite_dir = os.path.join(self._mirror_dir, "dists", self._suite_name)
+        contents_file = find_index_file(suite_dir, "%s/Contents-%s" % (component, arch_name))
 
         # Ubuntu does not place the Contents file in a component-specific directory,
         # so fall back to the global one.
-        if not os.path.isfile(contents_fname):
-            path = os.path.join(self._mirror_dir, "dists", self._suite_name, contents_basename)
-            if os.path.isfile(path):
-                contents_fname = path
+        if not contents_file:
+            contents_file = find_index_file(suite_dir, "Contents-%s" % (arch_name))
+        if not contents_file:
+            raise Exception("Could not find Contents index for %s/%s/%s" % (self._suite_name, component, arch_name))
 
         # load and preprocess the large file.
         # we don't show mercy to memory here, we just want the icon lookup to be fast,
         # so we need to cache the data.
-        f = gzip.open(contents_fname, 'r')
+        f = open_index_file(*contents_file)
         for line in f:
-            line = _decode_contents_line(line)
-            if line.startswith("usr/share/icons/hicolor/") or line.startswith("usr/share/pixmaps/"):
-                self._contents_data.append(line)
+            if line.startswith((b"usr/share/icons/hicolor/", b"usr/share/pixmaps/")):
+                self._contents_data.append(_decode_contents_line(line))
                 continue
 
             # allow Oxygen icon theme, needed to support KDE apps
-            if line.startswith("usr/share/icons/oxygen"):
-                self._contents_data.append(line)
+            if line.startswith(b"usr/share/icons/oxygen"):
+                self._contents_data.append(_decode_contents_line(line))
                 continue
 
             # in rare events, GNOME needs the same treatment, so special-case Adwaita as well
-            if line.startswith("usr/share/icons/Adwaita"):
-                self._contents_data.append(line)
+            if line.startswith(b"usr/share/icons/Adwaita"):
+                self._contents_data.append(_decode_contents_line(line))
                 continue
 
         f.close()
@@ -143,7 +141,7 @@ class ContentsListIconFinder(AbstractIconFinder):
             if not pkg:
                 continue
 
-            deb_fname = os.path.join(self._mirror_dir, pkg['filename'])
+            deb_fname = os.path.join(self._mirror_dir, pkg.filename)
             return {'icon_fname': path, 'deb_fname': deb_fname}
 
         return None
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2026 The dep11 contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import shutil
+import logging as log
+
+
+class ExportChangeLog:
+    '''
+    Records which files and directories in the export directory were
+    added, changed or removed, so only those need to be published.
+    Every process appends to its own queue file, which makes it safe
+    to use from multiprocessing workers.
+    '''
+
+    def __init__(self, export_dir, queue_dir):
+        self.export_dir = os.path.abspath(export_dir)
+        self.queue_dir = queue_dir
+
+    def _record(self, kind, path):
+        path = os.path.relpath(os.path.abspath(path), self.export_dir)
+        if path.startswith(".."):
+            log.warning("Not recording change outside of the export directory: %s" % (path))
+            return
+        if not os.path.exists(self.queue_dir):
+            os.makedirs(self.queue_dir, exist_ok=True)
+        queue_fname = os.path.join(self.queue_dir, "%i.list" % (os.getpid()))
+        with open(queue_fname, 'a') as f:
+            f.write("%s\t%s\n" % (kind, path))
+
+    def add_changed(self, path):
+        self._record("C", path)
+
+    def add_removed(self, path):
+        self._record("R", path)
+
+    def get_queue_files(self):
+        if not os.path.isdir(self.queue_dir):
+            return list()
+        return [os.path.join(self.queue_dir, f) for f in os.listdir(self.queue_dir) if f.endswith(".list")]
+
+    def get_changes(self, queue_files=None):
+        '''
+        Get the paths, relative to the export directory, which were
+        touched since the queue was last cleared.
+        '''
+        if queue_files == None:
+            queue_files = self.get_queue_files()
+        paths = set()
+        for fname in queue_files:
+            with open(fname, 'r') as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if not line:
+                        continue
+                    paths.add(line.split("\t", 1)[1])
+        return paths
+
+    def clear(self, queue_files=None):
+        if queue_files == None:
+            queue_files = self.get_queue_files()
+        for fname in queue_files:
+            os.remove(fname)
+
+
+def _remove_empty_dirs(d, root):
+    d = os.path.dirname(d)
+    while d != root and d.startswith(root) and os.path.isdir(d) and not os.listdir(d):
+        os.rmdir(d)
+        d = os.path.dirname(d)
+
+
+def _publish_file(src, dest):
+    dest_dir = os.path.dirname(dest)
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    # copy to a temporary file first, so nobody ever sees a partial file
+    tmp_dest = dest + ".publish-tmp"
+    shutil.copy2(src, tmp_dest)
+    os.replace(tmp_dest, dest)
+
+
+def _publish_dir(src, dest):
+    for root, dirs, files in os.walk(src):
+        dest_root = os.path.join(dest, os.path.relpath(root, src))
+        if os.path.isdir(dest_root):
+            # drop what doesn't exist in the source anymore
+            for entry in os.listdir(dest_root):
+                if entry in dirs or entry in files:
+                    continue
+                path = os.path.join(dest_root, entry)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        for fname in files:
+            _publish_file(os.path.join(root, fname), os.path.join(dest_root, fname))
+
+
+def publish_export(change_log, public_dir):
+    '''
+    Bring public_dir up to date with the export directory, by only
+    copying and removing the paths recorded in the change log.
+    If public_dir doesn't exist yet, the whole export directory is copied.
+    '''
+    public_dir = os.path.abspath(public_dir)
+    queue_files = change_log.get_queue_files()
+
+    if not os.path.exists(public_dir):
+        log.info("Public directory does not exist, copying the whole export directory.")
+        _publish_dir(change_log.export_dir, public_dir)
+        change_log.clear(queue_files)
+        return True
+
+    paths = change_log.get_changes(queue_files)
+    log.info("Publishing %i changed paths." % (len(paths)))
+    for path in sorted(paths):
+        src = os.path.join(change_log.export_dir, path)
+        dest = os.path.join(public_dir, path)
+        if os.path.isdir(src):
+            _publish_dir(src, dest)
+        elif os.path.isfile(src):
+            _publish_file(src, dest)
+        elif os.path.lexists(dest):
+            # the path is gone from the export directory
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                shutil.rmtree(dest)
+            else:
+                os.remove(dest)
+            _remove_empty_dirs(dest, public_dir)
+
+    change_log.clear(queue_files)
+    return True
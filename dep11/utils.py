@@ -15,8 +15,24 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this program.
 
+import os
+import sys
+import io
 import gzip
-from apt_pkg import TagFile, version_compare
+import lzma
+import pickle
+import hashlib
+from apt_pkg import TagSection, version_compare
+
+# compression variants of archive indices, in order of preference
+_INDEX_FILE_EXTENSIONS = ["", ".xz", ".gz"]
+# read archive indices in blocks of this size
+_INDEX_READ_BLOCK_SIZE = 1024 * 1024
+
+# parsed Packages indices, by file name
+_PACKAGES_INDEX_CACHE = dict()
+# directory to store parsed Packages indices in
+_PACKAGES_INDEX_CACHE_DIR = None
 
 def str_enc_dec(val):
     '''
@@ -29,29 +45,215 @@ def str_enc_dec(val):
 
     return val
 
-def read_packages_dict_from_file(archive_root, suite, component, arch):
-    source_path = archive_root + "/dists/%s/%s/binary-%s/Packages.gz" % (suite, component, arch)
+class PackageInfo:
+    '''
+    A binary package listed in a Packages index.
+    '''
+    __slots__ = ['name', 'version', 'arch', 'filename', 'maintainer']
+
+    def __init__(self, name, version, arch, filename, maintainer):
+        self.name = name
+        self.version = version
+        # there are only few distinct architectures and maintainers,
+        # so we share their strings between packages
+        self.arch = sys.intern(arch)
+        self.filename = filename
+        self.maintainer = sys.intern(maintainer)
+
+    def to_tuple(self):
+        return (self.name, self.version, self.arch, self.filename, self.maintainer)
+
+
+def _find_by_hash_index_file(suite_dir, relpath):
+    '''
+    Find an index file which is only available via its hash,
+    using the checksums listed in the suite's Release file.
+    '''
+    release_fname = os.path.join(suite_dir, "InRelease")
+    if not os.path.isfile(release_fname):
+        release_fname = os.path.join(suite_dir, "Release")
+    if not os.path.isfile(release_fname):
+        return None
+
+    checksums = dict()
+    with open(release_fname, 'r', encoding='utf-8', errors='replace') as f:
+        in_sha256 = False
+        for line in f:
+            if not line.startswith(" "):
+                in_sha256 = line.strip() == "SHA256:"
+                continue
+            if not in_sha256:
+                continue
+            parts = line.split()
+            if len(parts) == 3:
+                checksums[parts[2]] = parts[0]
+
+    for ext in _INDEX_FILE_EXTENSIONS:
+        checksum = checksums.get(relpath + ext)
+        if not checksum:
+            continue
+        fname = os.path.join(suite_dir, os.path.dirname(relpath), "by-hash", "SHA256", checksum)
+        if os.path.isfile(fname):
+            return (fname, ext)
+    return None
+
+
+def find_index_file(suite_dir, relpath):
+    '''
+    Find the best available variant of the archive index relpath (e.g. "main/binary-amd64/Packages")
+    in suite_dir. Uncompressed files are preferred over xz and gzip compressed ones, and
+    files which are only available by their hash are found as well.
+    Returns a tuple of the filename and its compression extension, or None.
+    '''
+    for ext in _INDEX_FILE_EXTENSIONS:
+        fname = os.path.join(suite_dir, relpath + ext)
+        if os.path.isfile(fname):
+            return (fname, ext)
+    return _find_by_hash_index_file(suite_dir, relpath)
+
+
+def open_index_file(fname, ext):
+    '''
+    Open an archive index file found by find_index_file() for reading,
+    decompressing it on the fly.
+    '''
+    if ext == ".xz":
+        f = lzma.open(fname, 'rb')
+    elif ext == ".gz":
+        f = gzip.open(fname, 'rb')
+    else:
+        f = open(fname, 'rb', buffering=0)
+    return io.BufferedReader(f, buffer_size=_INDEX_READ_BLOCK_SIZE)
+
+
+def _iter_index_paragraphs(f):
+    '''
+    Read the paragraphs of a deb822-style index file.
+    '''
+    remainder = b""
+    while True:
+        block = f.read(_INDEX_READ_BLOCK_SIZE)
+        if not block:
+            break
+        parts = (remainder + block).split(b"\n\n")
+        remainder = parts.pop()
+        for part in parts:
+            if part.strip():
+                yield part
+    if remainder.strip():
+        yield remainder
+
+
+def set_packages_index_cache_dir(path):
+    '''
+    Set a directory to store parsed Packages indices in, so they
+    don't need to be parsed again by later runs.
+    '''
+    global _PACKAGES_INDEX_CACHE_DIR
+    if not os.path.exists(path):
+        os.makedirs(path)
+    _PACKAGES_INDEX_CACHE_DIR = path
+
+
+def _get_packages_index_cache_fname(source_path):
+    if not _PACKAGES_INDEX_CACHE_DIR:
+        return None
+    name = hashlib.sha1(bytes(source_path, 'utf-8')).hexdigest()
+    return os.path.join(_PACKAGES_INDEX_CACHE_DIR, "%s.pickle" % (name))
+
+
+def _load_packages_index(source_path, index_key):
+    fname = _get_packages_index_cache_fname(source_path)
+    if not fname or not os.path.isfile(fname):
+        return None
+    try:
+        with open(fname, 'rb') as f:
+            key, pkgs = pickle.load(f)
+    except Exception:
+        return None
+    if key != index_key:
+        return None
 
-    f = gzip.open(source_path, 'rb')
-    tagf = TagFile(f)
     package_dict = dict()
-    for section in tagf:
-        pkg = dict()
-        pkg['arch'] = section['Architecture']
-        pkg['version'] = section['Version']
-        pkg['name'] = section['Package']
+    for pkg in pkgs:
+        package_dict[pkg[0]] = PackageInfo(*pkg)
+    return package_dict
+
+
+def _store_packages_index(source_path, index_key, package_dict):
+    fname = _get_packages_index_cache_fname(source_path)
+    if not fname:
+        return
+    pkgs = [pkg.to_tuple() for pkg in package_dict.values()]
+    with open(fname+".new", 'wb') as f:
+        pickle.dump((index_key, pkgs), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(fname+".new", fname)
+
+
+def read_packages_dict_from_file(archive_root, suite, component, arch):
+    '''
+    Get a dictionary of package names to the PackageInfo of the newest
+    version in the Packages index of suite/component/arch.
+    Indices are only parsed if they have changed since they were last read,
+    so the returned dictionary is shared and must not be modified.
+    '''
+    suite_dir = os.path.join(archive_root, "dists", suite)
+    relpath = "%s/binary-%s/Packages" % (component, arch)
+    index_name = os.path.join(suite_dir, relpath)
+    index_file = find_index_file(suite_dir, relpath)
+    if not index_file:
+        raise Exception("Could not find Packages index: %s" % (index_name))
+
+    st = os.stat(index_file[0])
+    index_key = (index_file[0], st.st_size, st.st_mtime_ns)
+    cached = _PACKAGES_INDEX_CACHE.get(index_name)
+    if cached and cached[0] == index_key:
+        return cached[1]
+
+    package_dict = _load_packages_index(index_name, index_key)
+    if package_dict == None:
+        package_dict = _parse_packages_file(index_file)
+        _store_packages_index(index_name, index_key, package_dict)
+
+    _PACKAGES_INDEX_CACHE[index_name] = (index_key, package_dict)
+    return package_dict
+
+
+def iter_packages_from_file(archive_root, suite, component, arch):
+    '''
+    Read the Packages index of suite/component/arch as a stream of PackageInfo
+    objects, without keeping the whole index in memory.
+    If a package is listed in multiple versions, all of them are returned.
+    '''
+    suite_dir = os.path.join(archive_root, "dists", suite)
+    relpath = "%s/binary-%s/Packages" % (component, arch)
+    index_file = find_index_file(suite_dir, relpath)
+    if not index_file:
+        raise Exception("Could not find Packages index: %s" % (os.path.join(suite_dir, relpath)))
+    return _iter_packages_file(index_file)
+
+
+def _iter_packages_file(index_file):
+    f = open_index_file(*index_file)
+    for paragraph in _iter_index_paragraphs(f):
+        section = TagSection(str(paragraph, 'utf-8', 'replace'))
         if not section.get('Filename'):
-            print("Package %s-%s has no filename specified." % (pkg['name'], pkg['version']))
+            print("Package %s-%s has no filename specified." % (section['Package'], section['Version']))
             continue
-        pkg['filename'] = section['Filename']
-        pkg['maintainer'] = section['Maintainer']
+        yield PackageInfo(section['Package'], section['Version'], section['Architecture'],
+                          section['Filename'], section['Maintainer'])
+    f.close()
+
 
-        pkg2 = package_dict.get(pkg['name'])
+def _parse_packages_file(index_file):
+    package_dict = dict()
+    for pkg in _iter_packages_file(index_file):
+        pkg2 = package_dict.get(pkg.name)
         if pkg2:
-            compare = version_compare(pkg2['version'], pkg['version'])
+            compare = version_compare(pkg2.version, pkg.version)
             if compare >= 0:
                 continue
-        package_dict[pkg['name']] = pkg
+        package_dict[pkg.name] = pkg
 
     return package_dict
 
@@ -15,12 +15,19 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this program.
 
+import io
 import yaml
 import gzip
 from optparse import OptionParser
+from collections import deque
+import multiprocessing as mp
 import sys
+import inspect
 import xml.etree.ElementTree as ET
-from voluptuous import Schema, Required, All, Any, Length, Range, Match, Url
+from voluptuous import Schema, Required, All, Any, Length, Range, Match, Url, \
+    Marker, Optional, Undefined, ALLOW_EXTRA
+
+ET.register_namespace("xml", "http://www.w3.org/XML/1998/namespace")
 
 __all__ = []
 
@@ -123,11 +130,175 @@ schema_component = Schema({
     'X-Source-Checksum': All(str, Length(min=10)),
 })
 
-class DEP11Validator:
-    issue_list = list()
+_LITERAL_TYPES = (str, int, float, bool, type(None))
+
+
+def _compile_check(schema, allow_extra=False):
+    '''
+    Build a function from a voluptuous schema which returns True if a value
+    is valid for it. It only uses plain type checks and comparisons, so it is
+    a lot faster than voluptuous, but it can't tell why a value is invalid.
+    Values it rejects need to be validated by voluptuous again, which may
+    still accept them.
+    '''
+    if isinstance(schema, Schema):
+        if isinstance(schema.schema, dict):
+            return _compile_mapping_check(schema.schema, schema.extra == ALLOW_EXTRA, schema.required)
+        return _compile_check(schema.schema, schema.extra == ALLOW_EXTRA)
+    if isinstance(schema, dict):
+        return _compile_mapping_check(schema, allow_extra, False)
+    if isinstance(schema, list):
+        if not schema:
+            return lambda v: isinstance(v, list) and not v
+        checks = [_compile_check(s, allow_extra) for s in schema]
+        if len(checks) == 1:
+            check = checks[0]
+            return lambda v: isinstance(v, list) and all(check(e) for e in v)
+        return lambda v: isinstance(v, list) and all(any(c(e) for c in checks) for e in v)
+    if inspect.isclass(schema):
+        return lambda v: isinstance(v, schema)
+    if isinstance(schema, All):
+        checks = [_compile_check(s, allow_extra) for s in schema.validators]
+        return lambda v: all(c(v) for c in checks)
+    if isinstance(schema, Any):
+        if all(type(s) in _LITERAL_TYPES for s in schema.validators):
+            values = set(schema.validators)
+            return lambda v: isinstance(v, _LITERAL_TYPES) and v in values
+        checks = [_compile_check(s, allow_extra) for s in schema.validators]
+        return lambda v: any(c(v) for c in checks)
+    if isinstance(schema, Length):
+        return lambda v: _check_length(v, schema.min, schema.max)
+    if isinstance(schema, Match):
+        pattern = schema.pattern
+        return lambda v: isinstance(v, str) and pattern.match(v) is not None
+    if type(schema) in _LITERAL_TYPES:
+        return lambda v: v == schema
+
+    # anything else (Range, Url, ...) is a callable which we just call
+    def check_callable(v):
+        try:
+            schema(v)
+        except Exception:
+            return False
+        return True
+    return check_callable
+
+
+def _check_length(v, min_len, max_len):
+    try:
+        length = len(v)
+    except TypeError:
+        return False
+    if min_len is not None and length < min_len:
+        return False
+    if max_len is not None and length > max_len:
+        return False
+    return True
+
+
+def _compile_mapping_check(schema, allow_extra, all_required):
+    # checks of the keys which are compared literally, and of the
+    # ones which are validated (like 'str'), in the order voluptuous tries them
+    key_checks = dict()
+    wildcard_checks = list()
+    required = list()
+    defaults = dict()
+    for skey, svalue in schema.items():
+        check = _compile_check(svalue, allow_extra)
+        key = skey
+        if isinstance(skey, Marker):
+            key = skey.schema
+            if not isinstance(skey.default, Undefined):
+                defaults[key] = (skey.default, check)
+            elif isinstance(skey, Required) or (all_required and not isinstance(skey, Optional)):
+                required.append(key)
+        elif all_required:
+            required.append(key)
+
+        if type(key) in _LITERAL_TYPES:
+            key_checks.setdefault(key, check)
+        elif isinstance(key, Any) and all(type(k) in _LITERAL_TYPES for k in key.validators):
+            for k in key.validators:
+                key_checks.setdefault(k, check)
+        else:
+            wildcard_checks.append((_compile_check(key, allow_extra), check))
 
-    def __init__(self):
-        pass
+    def check_mapping(v):
+        if not isinstance(v, dict):
+            return False
+        for key in required:
+            if key not in v:
+                return False
+        for key, (default, check) in defaults.items():
+            if key not in v and not check(default()):
+                return False
+        for key, value in v.items():
+            check = key_checks.get(key) if isinstance(key, _LITERAL_TYPES) else None
+            if check:
+                if not check(value):
+                    return False
+                continue
+            for key_check, check in wildcard_checks:
+                if key_check(key):
+                    if not check(value):
+                        return False
+                    break
+            else:
+                if not allow_extra:
+                    return False
+        return True
+    return check_mapping
+
+
+_check_component = _compile_check(schema_component)
+
+
+def _split_documents(f):
+    '''
+    Split the YAML stream f into the raw text of its documents, without
+    reading all of it into memory.
+    Yields the index of the first line of each document and its text.
+    '''
+    lines = list()
+    first_line = 0
+    for i, line in enumerate(f):
+        if line.startswith("---") and line[3:4] in ["", "\n", "\r", " ", "\t"] and lines:
+            yield (first_line, "".join(lines))
+            lines = list()
+            first_line = i
+        lines.append(line)
+    if lines:
+        yield (first_line, "".join(lines))
+
+
+# number of documents validated by one task when validating in parallel
+_VALIDATE_CHUNK_SIZE = 250
+
+
+def _iter_chunks(docs, size):
+    chunk = list()
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def _check_documents(chunk):
+    '''
+    Run the checks of a list of (first line, text) documents in a worker process.
+    '''
+    validator = DEP11Validator()
+    return [validator._check_document(first_line, text) for first_line, text in chunk]
+
+
+class DEP11Validator:
+    def __init__(self, jobs=1):
+        self.issue_list = list()
+        # number of processes used to validate documents
+        self.jobs = jobs
 
     def add_issue(self, msg):
         self.issue_list.append(msg)
@@ -159,13 +330,14 @@ class DEP11Validator:
 
         return self._test_localized_dict(doc, ldict, key)
 
-    def _test_custom_objects(self, lines):
-        ret = True
+    def _test_custom_objects(self, data, first_line=0):
+        if not "!!python/" in data:
+            return True
+        lines = data.split("\n")
         for i in range(0, len(lines)):
             if "!!python/" in lines[i]:
-                self.add_issue("Python object encoded in line %i." % (i))
-                ret = False
-        return ret
+                self.add_issue("Python object encoded in line %i." % (first_line + i))
+        return False
 
     def _validate_description_tag(self, docid, child, allowed_tags):
         ret = True
@@ -182,7 +354,6 @@ class DEP11Validator:
 
     def _validate_description(self, docid, desc, poshint="Description"):
         ret = True
-        ET.register_namespace("xml", "http://www.w3.org/XML/1998/namespace")
         try:
             root = ET.fromstring("<root>%s</root>" % (desc))
         except Exception as e:
@@ -197,114 +368,220 @@ class DEP11Validator:
                         ret = False
         return ret
 
-    def validate_data(self, data):
-        ret = True
-        ids_found = dict()
-
-        lines = data.split("\n")
-
-        # see if there are any Python-specific objects encoded
-        ret = self._test_custom_objects(lines)
-
+    def _check_document(self, first_line, text):
+        '''
+        Run all checks on a component document which don't depend on other documents.
+        Returns a tuple of the issues found until the component was identified,
+        whether those were fine, the component's ID and package (the ID is None
+        if the document was rejected), the issues found with the component
+        and whether it is valid.
+        '''
+        issues = self.issue_list
         try:
-            docs = yaml.safe_load_all(data)
-            header = next(docs)
-        except Exception as e:
-            self.add_issue("Could not parse file: %s" % (str(e)))
-            return False
+            self.issue_list = list()
+            # see if there are any Python-specific objects encoded
+            valid = self._test_custom_objects(text, first_line)
 
-        try:
-            schema_header(header)
-        except Exception as e:
-            self.add_issue("Invalid DEP-11 header: %s" % (str(e)))
-            ret = False
-
-        for doc in docs:
+            try:
+                doc = yaml.safe_load(text)
+            except Exception as e:
+                self.add_issue("FATAL: Could not parse document in line %i: %s" % (first_line, str(e)))
+                return (self.issue_list, False, None, None, None, False)
+            if not doc:
+                self.add_issue("FATAL: Empty document found.")
+                return (self.issue_list, False, None, None, None, False)
             docid = doc.get('ID')
             pkgname = doc.get('Package')
             if not pkgname:
                 pkgname = "?unknown?"
-            if not doc:
-                self.add_issue("FATAL: Empty document found.")
-                ret = False
-                continue
             if not docid:
                 self.add_issue("FATAL: Component without ID found.")
-                ret = False
-                continue
-            if ids_found.get(docid):
-                self.add_issue("FATAL: Found two components with the same ID: %s (in packages %s and %s)." % (docid, ids_found[docid], pkgname))
-                ret = False
-                continue
-            else:
-                ids_found[docid] = pkgname
+                return (self.issue_list, False, None, None, None, False)
+
+            pre_issues = self.issue_list
+            self.issue_list = list()
+            cpt_valid = self._validate_component(docid, doc)
+            return (pre_issues, valid, docid, pkgname, self.issue_list, cpt_valid)
+        finally:
+            self.issue_list = issues
+
+    def _add_document_result(self, result, ids_found):
+        '''
+        Add the result of _check_document() to the issues, and check that the
+        component's ID is unique. ids_found maps the IDs of the components
+        seen so far to their packages.
+        '''
+        pre_issues, valid, docid, pkgname, cpt_issues, cpt_valid = result
+        self.issue_list.extend(pre_issues)
+        if not docid:
+            return False
+        if ids_found.get(docid):
+            self.add_issue("FATAL: Found two components with the same ID: %s (in packages %s and %s)." % (docid, ids_found[docid], pkgname))
+            return False
+        else:
+            ids_found[docid] = pkgname
+
+        self.issue_list.extend(cpt_issues)
+        return valid and cpt_valid
+
+    def _validate_component(self, docid, doc):
+        ret = True
+        # only run voluptuous to find out what's wrong with a component
+        if not _check_component(doc):
             try:
                 schema_component(doc)
             except Exception as e:
                 self.add_issue("[%s]: %s" % (docid, str(e)))
-                ret = False
-                continue
-
-            # more tests for the icon key
-            icon = doc.get('Icon')
-            if (doc['Type'] == "desktop-app") or (doc['Type'] == "web-app"):
-                if not doc.get('Icon'):
-                    self.add_issue("[%s]: %s" % (docid, "Components containing an application must have an 'Icon' key."))
-                    ret = False
-            if icon:
-                if (not icon.get('stock')) and (not icon.get('cached')) and (not icon.get('local')):
-                    self.add_issue("[%s]: %s" % (docid, "A 'stock', 'cached' or 'local' icon must at least be provided. @ data['Icon']"))
-                    ret = False
+                return False
 
-            if not self._test_localized(doc, 'Name'):
+        # more tests for the icon key
+        icon = doc.get('Icon')
+        if (doc['Type'] == "desktop-app") or (doc['Type'] == "web-app"):
+            if not doc.get('Icon'):
+                self.add_issue("[%s]: %s" % (docid, "Components containing an application must have an 'Icon' key."))
                 ret = False
-            if not self._test_localized(doc, 'Summary'):
-                ret = False
-            if not self._test_localized(doc, 'Description'):
-                ret = False
-            if not self._test_localized(doc, 'DeveloperName'):
+        if icon:
+            if (not icon.get('stock')) and (not icon.get('cached')) and (not icon.get('local')):
+                self.add_issue("[%s]: %s" % (docid, "A 'stock', 'cached' or 'local' icon must at least be provided. @ data['Icon']"))
                 ret = False
 
-            for shot in doc.get('Screenshots', list()):
-                caption = shot.get('caption')
-                if caption:
-                    if not self._test_localized_dict(doc, caption, "Screenshots.x.caption"):
-                        ret = False
+        if not self._test_localized(doc, 'Name'):
+            ret = False
+        if not self._test_localized(doc, 'Summary'):
+            ret = False
+        if not self._test_localized(doc, 'Description'):
+            ret = False
+        if not self._test_localized(doc, 'DeveloperName'):
+            ret = False
 
-            for rel in doc.get('Releases', list()):
-                desc = rel.get('description')
-                if not desc:
-                    continue
-                if not self._test_localized_dict(doc, desc, "Releases.x.description"):
+        for shot in doc.get('Screenshots', list()):
+            caption = shot.get('caption')
+            if caption:
+                if not self._test_localized_dict(doc, caption, "Screenshots.x.caption"):
                     ret = False
-                for d in desc.values():
-                    if not self._validate_description(docid, d, "Releases.x.description"):
-                        ret = False
 
-            desc = doc.get('Description', dict())
+        for rel in doc.get('Releases', list()):
+            desc = rel.get('description')
+            if not desc:
+                continue
+            if not self._test_localized_dict(doc, desc, "Releases.x.description"):
+                ret = False
             for d in desc.values():
-                if not self._validate_description(docid, d):
+                if not self._validate_description(docid, d, "Releases.x.description"):
                     ret = False
 
+        desc = doc.get('Description', dict())
+        for d in desc.values():
+            if not self._validate_description(docid, d):
+                ret = False
+
         return ret
 
+    def begin_stream(self):
+        '''
+        Start validating a DEP-11 stream which is passed to feed() piece by piece,
+        for example while it is written. Call end_stream() to get the result.
+        '''
+        self._stream_valid = True
+        self._stream_failed = False
+        self._stream_line = 0
+        self._header_found = False
+        self._ids_found = dict()
+
+    def _feed_document(self, first_line, text):
+        if self._stream_failed:
+            return
+        if self._header_found:
+            if not self._add_document_result(self._check_document(first_line, text), self._ids_found):
+                self._stream_valid = False
+            return
+
+        # the first document is the header
+        self._header_found = True
+        # see if there are any Python-specific objects encoded
+        if not self._test_custom_objects(text, first_line):
+            self._stream_valid = False
+        try:
+            header = yaml.safe_load(text)
+        except Exception as e:
+            self.add_issue("Could not parse file: %s" % (str(e)))
+            self._stream_failed = True
+            return
+        try:
+            schema_header(header)
+        except Exception as e:
+            self.add_issue("Invalid DEP-11 header: %s" % (str(e)))
+            self._stream_valid = False
+
+    def feed(self, data):
+        '''
+        Validate the complete YAML documents in the string data, which
+        continues the stream started with begin_stream().
+        '''
+        for first_line, text in _split_documents(io.StringIO(data)):
+            self._feed_document(self._stream_line + first_line, text)
+        self._stream_line += data.count("\n")
+
+    def end_stream(self):
+        '''
+        Finish validating a stream, and return whether it was valid.
+        '''
+        if not self._header_found:
+            self.add_issue("Could not parse file: No DEP-11 header found.")
+            return False
+        return self._stream_valid and not self._stream_failed
+
+    def validate_stream(self, f):
+        '''
+        Validate DEP-11 data read from the text stream f. The documents are
+        validated one by one, so only the IDs of the components are kept in memory.
+        '''
+        self.begin_stream()
+        docs = _split_documents(f)
+        for first_line, text in docs:
+            self._feed_document(first_line, text)
+            # the header is checked here, the components may be checked in parallel
+            if self.jobs > 1:
+                break
+        if self.jobs <= 1 or self._stream_failed:
+            return self.end_stream()
+
+        # check chunks of documents in parallel, and merge their results in order.
+        # Only a few chunks are in flight at a time, to keep the memory use bounded.
+        with mp.Pool(self.jobs) as pool:
+            pending = deque()
+            def add_results(async_result):
+                for result in async_result.get():
+                    if not self._add_document_result(result, self._ids_found):
+                        self._stream_valid = False
+
+            for chunk in _iter_chunks(docs, _VALIDATE_CHUNK_SIZE):
+                pending.append(pool.apply_async(_check_documents, (chunk,)))
+                if len(pending) >= self.jobs * 2:
+                    add_results(pending.popleft())
+            while pending:
+                add_results(pending.popleft())
+
+        return self.end_stream()
+
+    def validate_data(self, data):
+        return self.validate_stream(io.StringIO(data))
+
     def validate_file(self, fname):
         f = None
         if fname.endswith(".gz"):
-            f = gzip.open(fname, 'r')
+            f = gzip.open(fname, 'rt', encoding='utf-8')
         else:
-            f = open(fname, 'r')
+            f = open(fname, 'r', encoding='utf-8')
 
-        data = str(f.read(), 'utf-8')
-        f.close()
-
-        return self.validate_data(data)
+        with f:
+            return self.validate_stream(f)
 
     def print_issues(self):
         for issue in self.issue_list:
             print(issue)
 
-    def clear_issues():
+    def clear_issues(self):
         self.issue_list = list()
 
 __all__.append('DEP11Validator')
@@ -316,6 +593,9 @@ def main():
     parser.add_option("--no-color",
                   action="store_true", dest="no_color", default=False,
                   help="don't print colored output")
+    parser.add_option("-j", "--jobs",
+                  type="int", dest="jobs", default=1,
+                  help="number of processes used for validation")
 
     (options, args) = parser.parse_args()
 
@@ -324,7 +604,7 @@ def main():
         sys.exit(4)
     fname = args[0]
 
-    validator = DEP11Validator()
+    validator = DEP11Validator(options.jobs)
     ret = validator.validate_file(fname)
     validator.print_issues()
     if ret: